@@ -92,11 +92,19 @@ class Submit(Page):
         if not player.buyer and amount < player.cost_or_value:
             raise ValueError("Ask cannot be below your cost")
 
+        with player.session as session:
+            if str(player.round) in session.get("clearings", {}):
+                raise ValueError("The bidding period has ended")
+
         player.bid = amount
 
         return amount
 
 
+class WaitForBids(SynchronizingWait):
+    synchronize = "session"
+
+
 class Results(Page):
     @classmethod
     def before_once(page, player: PlayerType) -> None:
@@ -105,32 +113,13 @@ class Results(Page):
         num_rounds = session_setting(session, "num_rounds")
         player.add_round = round_num < num_rounds
 
-        bids, asks = bids_and_asks(session, round_num)
-
-        clearing_price = None
-        quantity = 0
-
-        if bids and asks:
-            eq = find_equilibrium(
-                [Decimal(str(b)) for b in bids],
-                [Decimal(str(a)) for a in asks],
-            )
-            if eq and eq.quantity > 0:
-                clearing_price = round((float(eq.price_min) + float(eq.price_max)) / 2)
-                quantity = eq.quantity
-
-        player.clearing_price = clearing_price
-        player.market_quantity = quantity
+        clearing = clear_round(session, round_num)
+        player.clearing_price = clearing["price"]
+        player.market_quantity = clearing["quantity"]
 
-        # Determine if this player traded
-        my_bid = player.within(app=__name__, round=round_num).get("bid")
-        if clearing_price is not None and my_bid is not None:
-            if player.buyer and my_bid >= clearing_price:
-                player.traded = True
-                player.profit = player.cost_or_value - clearing_price
-            elif not player.buyer and my_bid <= clearing_price:
-                player.traded = True
-                player.profit = clearing_price - player.cost_or_value
+        if player.name in clearing["profits"]:
+            player.traded = True
+            player.profit = clearing["profits"][player.name]
 
 
 def digest(session: SessionType) -> dict[str, Any]:
@@ -192,9 +181,9 @@ def player_data_for_round(player: PlayerType, round_num: int) -> Any:
     return player.within(app=__name__, round=round_num)
 
 
-def bids_and_asks(session: SessionType, round_num: int) -> tuple[list[int], list[int]]:
-    submitted_bids = []
-    submitted_asks = []
+def offers(session: SessionType, round_num: int) -> list[tuple[str, bool, int, int]]:
+    """(name, buyer, cost or value, bid or ask) of all offers in a round"""
+    result = []
 
     for player in session.players:
         if player.get("buyer") is None:
@@ -205,7 +194,17 @@ def bids_and_asks(session: SessionType, round_num: int) -> tuple[list[int], list
         if bid is None:
             continue
 
-        if player.get("buyer"):
+        result.append((player.name, player.buyer, player.cost_or_value, bid))
+
+    return result
+
+
+def bids_and_asks(session: SessionType, round_num: int) -> tuple[list[int], list[int]]:
+    submitted_bids = []
+    submitted_asks = []
+
+    for _, buyer, _, bid in offers(session, round_num):
+        if buyer:
             submitted_bids.append(bid)
         else:
             submitted_asks.append(bid)
@@ -213,16 +212,59 @@ def bids_and_asks(session: SessionType, round_num: int) -> tuple[list[int], list
     return sorted(submitted_bids, reverse=True), sorted(submitted_asks)
 
 
-def market_result(session: SessionType, round_num: int) -> Any:
-    for player in session.players:
-        round_data = player_data_for_round(player, round_num)
+def clear_round(session: SessionType, round_num: int) -> dict[str, Any]:
+    """
+    Clear a round once, when the first player reaches its Results
+
+    Everyone has left Submit by then (WaitForBids), so no bid is in flight.
+    The clearing price, the quantity and the profit of every player who traded
+    are stored in session.clearings, keyed by round, so that the other players'
+    Results, the digest and the pipeline only look them up.
+    """
+    with session:
+        clearings = session.get("clearings", {})
+
+        if str(round_num) in clearings:
+            return cast(dict[str, Any], clearings[str(round_num)])
 
-        if round_data.get("clearing_price") is not None:
-            return round_data.get("clearing_price"), round_data.get(
-                "market_quantity", 0
+        round_offers = offers(session, round_num)
+        bids = sorted((bid for _, buyer, _, bid in round_offers if buyer), reverse=True)
+        asks = sorted(bid for _, buyer, _, bid in round_offers if not buyer)
+
+        clearing_price = None
+        quantity = 0
+        profits = {}
+
+        if bids and asks:
+            eq = find_equilibrium(
+                [Decimal(str(b)) for b in bids],
+                [Decimal(str(a)) for a in asks],
             )
+            if eq and eq.quantity > 0:
+                clearing_price = round((float(eq.price_min) + float(eq.price_max)) / 2)
+                quantity = eq.quantity
+
+        if clearing_price is not None:
+            for name, buyer, cost_or_value, bid in round_offers:
+                if buyer and bid >= clearing_price:
+                    profits[name] = cost_or_value - clearing_price
+                elif not buyer and bid <= clearing_price:
+                    profits[name] = clearing_price - cost_or_value
+
+        clearing = {"price": clearing_price, "quantity": quantity, "profits": profits}
+        session.clearings = {**clearings, str(round_num): clearing}
+
+        return clearing
+
+
+def market_result(session: SessionType, round_num: int) -> Any:
+    with session:
+        clearing = session.get("clearings", {}).get(str(round_num))
+
+    if clearing is None:
+        return None, 0
 
-    return None, 0
+    return clearing["price"], clearing["quantity"]
 
 
 def pipeline(session: SessionType) -> list[dict[str, Any]]:
@@ -264,6 +306,7 @@ page_order = [
     Instructions,
     Repeat(
         Submit,
+        WaitForBids,
         Results,
     ),
 ]
@@ -22,12 +22,20 @@ The auction follows these principles:
 - Trades occur when a buyer accepts an ask or a seller accepts a bid
 """
 
+import asyncio
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
 from decimal import Decimal
-from time import time
+from functools import lru_cache
+from itertools import islice
+from time import perf_counter, time
 from typing import Any, cast
 from uuid import UUID
 
 import uproot.models as um
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
 from find_eq import find_equilibrium
 from uproot.fields import *
 from uproot.smithereens import *
@@ -38,6 +46,9 @@ LANDING_PAGE = False
 
 class C:
     DETECTION_PERIOD = 30.0
+    DIFF_BUFFER = 256  # Market diffs per round kept for clients that resync
+    STATS_SAMPLES = 10_000  # Latency samples per round and method kept for stats
+    LIVE_METHODS = ("make_offer", "accept_offer", "get_market")
     DEFAULT_BUYER_TAX = 0
     DEFAULT_SELLER_TAX = 0
     DEFAULT_DURATION = 25 * 60
@@ -46,6 +57,10 @@ class C:
     DEFAULT_COSTS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     DEFAULT_BUYER_CAN_OFFER = True
     DEFAULT_SELLER_CAN_OFFER = True
+    DEFAULT_BROADCAST_WINDOW = 30  # Milliseconds; 0 sends every diff right away
+    DEFAULT_MATCHING_LOOP = False
+    DEFAULT_SIMULATE_ZIP_SHARE = 0.0  # Share of simulated traders using ZIP
+    DEFAULT_SIMULATE_INTERVAL = 1000  # Milliseconds between simulated actions
 
 
 def is_integer(value: Any) -> bool:
@@ -133,7 +148,26 @@ def new_session(session: SessionType) -> None:
     ):
         raise ValueError("costs must be a non-empty integer list")
 
-    for key in ("buyer_can_offer", "seller_can_offer"):
+    broadcast_window = session_setting(session, "broadcast_window")
+
+    if not is_integer(broadcast_window) or broadcast_window < 0:
+        raise ValueError("broadcast_window must be a non-negative integer")
+
+    zip_share = session_setting(session, "simulate_zip_share")
+
+    if (
+        not isinstance(zip_share, (int, float))
+        or isinstance(zip_share, bool)
+        or not 0 <= zip_share <= 1
+    ):
+        raise ValueError("simulate_zip_share must be a number between 0 and 1")
+
+    simulate_interval = session_setting(session, "simulate_interval")
+
+    if not is_integer(simulate_interval) or simulate_interval <= 0:
+        raise ValueError("simulate_interval must be a positive integer")
+
+    for key in ("buyer_can_offer", "seller_can_offer", "matching_loop"):
         val = session_setting(session, key)
 
         if not isinstance(val, bool):
@@ -159,15 +193,22 @@ def new_session(session: SessionType) -> None:
 
 class Context(PlayerContext):
     @property
-    def present(self) -> list[Any]:
-        return [p for p in self.player.session.players if p.present]
+    def present(self) -> list[str]:
+        """Names of the present players in the order in which they checked in"""
+        checked_in = [
+            (player.get("checked_in", 0), player.name)
+            for player in self.player.session.players
+            if player.get("present", False)
+        ]
+
+        return [name for _, name in sorted(checked_in)]
 
 
 class RaiseHands(Page):
     @classmethod
     def reset_session(page, player: PlayerType) -> None:
-        for p in player.session.players:
-            p.present = False
+        # Players who never check in keep an unset player.present, see show()
+        player.session.checkins = 0
 
     @classmethod
     def ensure_detection(page, player: PlayerType) -> None:
@@ -191,7 +232,15 @@ class RaiseHands(Page):
 
     @live
     def set_presence(page, player: PlayerType, new_value: bool) -> Any:
-        player.present = new_value
+        session = player.session
+
+        with session:
+            if new_value and not player.get("present", False):
+                # Check-in sequence number, sorted once when roles are assigned
+                session.checkins = session.get("checkins", 0) + 1
+                player.checked_in = session.checkins
+
+            player.present = new_value
 
         return new_value
 
@@ -199,16 +248,21 @@ class RaiseHands(Page):
 class Assignment(NoshowPage):
     @classmethod
     def after_always_once(page, player: PlayerType) -> None:
-        if not player.present:
+        if not player.get("present", False):
             return
 
         session = player.session
-        present = player.context.present
 
         with session:
             assignment = session.get("double_auction_assignment")
 
             if assignment is None:
+                # Freeze the check-in order so that each slot is a single lookup
+                present = player.context.present
+                session.double_auction_slots = {
+                    name: i for i, name in enumerate(present)
+                }
+
                 values = session_setting(session, "values")
                 costs = session_setting(session, "costs")
 
@@ -236,55 +290,367 @@ class Assignment(NoshowPage):
                 rng().shuffle(assignment)
                 session.double_auction_assignment = assignment
 
-        my_id = present.index(player)
+            my_id = session.double_auction_slots.get(player.name)
+
+        if my_id is None:
+            # Checked in after the roles were assigned: sit out like a no-show
+            player.present = False
+            return
+
         player.buyer, player.cost_or_value = assignment[my_id]
 
 
-def market_data(
-    offers_model: Any,
-    txs_model: Any,
-    round: int,
-) -> dict[str, list[dict[str, Any]]]:
+def percentiles(samples: Iterable[float]) -> dict[str, float] | None:
+    """Nearest-rank p50/p95/p99 of the samples, or None if there are none"""
+    data = sorted(samples)
+
+    if not data:
+        return None
+
+    def rank(q: float) -> float:
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+    return {"n": len(data), "p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99)}
+
+
+class RoundStats:
     """
-    Extract current market state: active bids, asks, and executed trades
+    Load statistics of one round of a simulated session since the server started
 
-    The market book separates buy and sell orders, showing only
-    the most recent valid offer from each participant.
+    Attributes:
+        calls: Successful live calls per method
+        errors: Live calls per method that raised
+        server_ms: Server-side durations of live calls per method
+        client_ms: Round-trip latencies reported by simulated clients per method
+        fanout_ms: Time spent sending each MarketDiff to all participants
+        first: Wall-clock time of the first live call
+        last: Wall-clock time of the latest live call
+    """
 
-    Args:
-        offers_model: Model containing all offers
-        txs_model: Model containing all transactions
-        round: Current trading round
+    def __init__(self) -> None:
+        self.calls: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.server_ms: dict[str, deque[float]] = {}
+        self.client_ms: dict[str, deque[float]] = {}
+        self.fanout_ms: deque[float] = deque(maxlen=C.STATS_SAMPLES)
+        self.first: float | None = None
+        self.last: float | None = None
+
+    def record_call(self, method: str, duration_ms: float, ok: bool) -> None:
+        now = time()
+
+        if self.first is None:
+            self.first = now
+
+        self.last = now
+        counter = self.calls if ok else self.errors
+        counter[method] = counter.get(method, 0) + 1
+        self.server_ms.setdefault(method, deque(maxlen=C.STATS_SAMPLES)).append(
+            duration_ms
+        )
 
-    Returns:
-        Dictionary with 'asks', 'bids', and 'txs' lists
+    def record_client(self, method: str, samples: list[float]) -> None:
+        self.client_ms.setdefault(method, deque(maxlen=C.STATS_SAMPLES)).extend(samples)
+
+    def summary(self) -> dict[str, Any]:
+        span = (
+            self.last - self.first
+            if self.first is not None and self.last is not None
+            else 0.0
+        )
+        offers = self.calls.get("make_offer", 0)
+
+        return {
+            "calls": dict(self.calls),
+            "errors": dict(self.errors),
+            "offers_per_sec": offers / span if span > 0 else None,
+            "server_ms": {m: percentiles(v) for m, v in self.server_ms.items()},
+            "client_ms": {m: percentiles(v) for m, v in self.client_ms.items()},
+            "fanout_ms": percentiles(self.fanout_ms),
+        }
+
+
+class RoundBook:
     """
-    traded_players = players_traded_in_round(txs_model, round)
+    In-memory index of one round's offer book
 
-    # Map each player to their latest offer (last one wins)
-    player_offers: dict[PlayerIdentifier, tuple[UUID, bool, int | None]] = {}
+    The offer and transaction ledgers remain the source of truth. This index is
+    updated whenever an entry is appended to either of them and rebuilt from
+    them on first access after a restart, so that live calls do not have to
+    rescan the ledgers.
 
-    for entry_id, _, entry in um.filter_entries(offers_model, Offer, round=round):
-        player_offers[entry.pid] = (entry_id, entry.buy, entry.price)
+    Attributes:
+        latest: Latest offer entry per player as (offer_id, buy, price)
+        active: Valid offers by ID as (pid, buy, price)
+        traded: Transaction ID and price per player who has traded
+        txs: Execution prices in ledger order
+        entries: Number of ledger entries (offers and transactions) applied
+        seq: Sequence number of the latest market diff
+        diffs: Ring buffer of the most recent market diffs
+        undo: Active offer (or None) at seq of every offer changed since then
+
+    A diff's sequence number is the number of ledger entries applied when it was
+    recorded. Sequence numbers therefore increase monotonically and stay valid
+    across restarts, when the index is rebuilt with seq equal to the ledger
+    length.
+
+    Changes that are still waiting in the broadcast window are not part of any
+    diff yet. Snapshots are therefore taken as of seq, by undoing them.
+    """
 
-    # Partition valid offers into market sides
-    bids: list[dict[str, Any]] = []
-    asks: list[dict[str, Any]] = []
+    def __init__(self) -> None:
+        self.latest: dict[PlayerIdentifier, tuple[UUID, bool, int | None]] = {}
+        self.active: dict[UUID, tuple[PlayerIdentifier, bool, int]] = {}
+        self.traded: dict[PlayerIdentifier, tuple[UUID, int]] = {}
+        self.txs: list[int] = []
+        self.entries = 0
+        self.seq = 0
+        self.diffs: deque[dict[str, Any]] = deque(maxlen=C.DIFF_BUFFER)
+        self.undo: dict[UUID, tuple[PlayerIdentifier, bool, int] | None] = {}
+        self.txs_at_seq = 0
+        self._aggregates: tuple[int, dict[str, list[int]]] | None = None
+
+    def apply_offer(
+        self,
+        offer_id: UUID,
+        pid: PlayerIdentifier,
+        buy: bool,
+        price: int | None,
+    ) -> None:
+        previous = self.latest.get(pid)
+
+        if previous is not None:
+            self.remove(previous[0])
+
+        self.latest[pid] = (offer_id, buy, price)
+        self.entries += 1
+
+        if price is None or pid in self.traded:
+            return
 
-    for pid, (offer_id, is_buy, price) in player_offers.items():
-        if pid in traded_players or price is None:
-            continue
+        self.undo.setdefault(offer_id, None)
+        self.active[offer_id] = (pid, buy, price)
 
-        (bids if is_buy else asks).append({"id": offer_id, "price": price})
+    def apply_transaction(
+        self,
+        tx_id: UUID,
+        price: int,
+        players: tuple[PlayerIdentifier, ...],
+    ) -> None:
+        for pid in players:
+            self.traded[pid] = (tx_id, price)
+            previous = self.latest.get(pid)
 
-    return {
-        "asks": asks,
-        "bids": bids,
-        "txs": [
-            {"price": entry.price}
-            for _, _, entry in um.filter_entries(txs_model, Transaction, round=round)
-        ],
-    }
+            if previous is not None:
+                self.remove(previous[0])
+
+        self.txs.append(price)
+        self.entries += 1
+
+    def remove(self, offer_id: UUID) -> None:
+        if offer_id in self.active:
+            self.undo.setdefault(offer_id, self.active.pop(offer_id))
+
+    def active_offer(self, pid: PlayerIdentifier) -> tuple[UUID, int] | None:
+        previous = self.latest.get(pid)
+
+        if previous is None or previous[0] not in self.active:
+            return None
+
+        return previous[0], self.active[previous[0]][2]
+
+    def market_data(self) -> dict[str, Any]:
+        """Snapshot of the book as of seq, without the changes not yet sent"""
+        bids: list[dict[str, Any]] = []
+        asks: list[dict[str, Any]] = []
+
+        for offer_id, (_, is_buy, price) in self.active.items():
+            if offer_id not in self.undo:
+                (bids if is_buy else asks).append({"id": offer_id, "price": price})
+
+        for offer_id, offer in self.undo.items():
+            if offer is not None:
+                _, is_buy, price = offer
+                (bids if is_buy else asks).append({"id": offer_id, "price": price})
+
+        return {
+            "seq": self.seq,
+            "asks": asks,
+            "bids": bids,
+            "txs": [{"price": price} for price in islice(self.txs, self.txs_at_seq)],
+        }
+
+    def aggregates(self) -> dict[str, list[int]]:
+        """Sorted standing bids and asks and all prices, cached by ledger length"""
+        if self._aggregates is None or self._aggregates[0] != self.entries:
+            bids = [price for _, is_buy, price in self.active.values() if is_buy]
+            asks = [price for _, is_buy, price in self.active.values() if not is_buy]
+
+            self._aggregates = (
+                self.entries,
+                {
+                    "actual_bids": sorted(bids, reverse=True),
+                    "actual_asks": sorted(asks),
+                    "transactions": list(self.txs),
+                },
+            )
+
+        return self._aggregates[1]
+
+    def record_diff(
+        self,
+        remove: list[UUID],
+        add: list[dict[str, Any]],
+        txs: list[dict[str, Any]],
+    ) -> dict[str, Any]:
+        diff = {
+            "seq": self.entries,
+            "prev": self.seq,
+            "remove": remove,
+            "add": add,
+            "txs": txs,
+        }
+        self.seq = self.entries
+        self.diffs.append(diff)
+        self.settle()
+
+        return diff
+
+    def settle(self) -> None:
+        """Mark all changes as sent, i.e., reflected in seq"""
+        self.undo.clear()
+        self.txs_at_seq = len(self.txs)
+
+    def diffs_since(self, since: int) -> list[dict[str, Any]] | None:
+        """Return the diffs recorded after `since`, or None if they are gone"""
+        if since == self.seq:
+            return []
+
+        for i, diff in enumerate(self.diffs):
+            if diff["prev"] == since:
+                return list(islice(self.diffs, i, None))
+
+        return None
+
+
+_books: dict[tuple[str, int], RoundBook] = {}  # Rounds being traded
+_stats: dict[tuple[str, int], RoundStats] = {}  # Rounds of simulated sessions
+_summaries: dict[tuple[str, int], tuple[int, int, dict[str, list[int]]]] = {}
+
+
+def _book_key(session: SessionType, round: int) -> tuple[str, int]:
+    return str(session.offers), round
+
+
+def reconstruct_book(session: SessionType, round: int) -> RoundBook:
+    """Replay one round of the offer and transaction ledgers into a fresh index"""
+    book = RoundBook()
+
+    for entry_id, _, offer in um.filter_entries(session.offers, Offer, round=round):
+        book.apply_offer(entry_id, offer.pid, offer.buy, offer.price)
+
+    for tx_id, _, transaction in um.filter_entries(
+        session.txs, Transaction, round=round
+    ):
+        book.apply_transaction(
+            tx_id, transaction.price, transaction_players(transaction)
+        )
+
+    book.seq = book.entries
+    book.settle()
+
+    return book
+
+
+def get_book(session: SessionType, round: int) -> RoundBook:
+    key = _book_key(session, round)
+
+    if key not in _books:
+        _books[key] = reconstruct_book(session, round)
+
+    return _books[key]
+
+
+def peek_book(session: SessionType, round: int) -> RoundBook:
+    """The round's book if it is in memory, otherwise rebuilt without keeping it"""
+    book = _books.get(_book_key(session, round))
+
+    return book if book is not None else reconstruct_book(session, round)
+
+
+def ledger_length(mid: ModelIdentifier) -> int:
+    """Number of entries in a ledger, without parsing them"""
+    with um.get_storage(mid) as storage:
+        return len(storage.history().get("entry", []))
+
+
+def round_summary(session: SessionType, round: int) -> tuple[int, dict[str, list[int]]]:
+    """
+    Number of ledger entries and aggregates of a round
+
+    Rounds that are not in memory are rebuilt once and their summary is kept
+    until either ledger grows, so that reports do not replay them every time.
+    """
+    key = _book_key(session, round)
+    book = _books.get(key)
+
+    if book is not None:
+        return book.entries, book.aggregates()
+
+    length = ledger_length(session.offers) + ledger_length(session.txs)
+    cached = _summaries.get(key)
+
+    if cached is None or cached[0] != length:
+        book = reconstruct_book(session, round)
+        cached = _summaries[key] = (length, book.entries, book.aggregates())
+
+    return cached[1], cached[2]
+
+
+def round_stats(session: SessionType, round: int) -> RoundStats | None:
+    """Load statistics of the round, which are only kept for simulated sessions"""
+    if not session._uproot_simulate:
+        return None
+
+    return _stats.setdefault(_book_key(session, round), RoundStats())
+
+
+def end_round(session: SessionType, round: int) -> None:
+    """
+    Drop the in-memory state of a round once its trading time is over
+
+    This is called whenever a player leaves Trade and does nothing if already
+    done, so state that a late live call brings back is dropped again.
+    """
+    key = _book_key(session, round)
+    coalescer = _coalescers.get(key[0])
+
+    if coalescer is not None and coalescer.round == round:
+        coalescer.flush()
+
+    _books.pop(key, None)
+
+    if round == session_setting(session, "num_rounds"):
+        _coalescers.pop(key[0], None)
+        _matchers.pop(key[0], None)
+
+
+def market_data(session: SessionType, round: int) -> dict[str, Any]:
+    """
+    Extract current market state: active bids, asks, and executed trades
+
+    The market book separates buy and sell orders, showing only
+    the most recent valid offer from each participant.
+
+    Args:
+        session: Session holding the offer and transaction ledgers
+        round: Current trading round
+
+    Returns:
+        Dictionary with 'asks', 'bids', and 'txs' lists as of the latest market
+        diff, and that diff's 'seq'
+    """
+    return get_book(session, round).market_data()
 
 
 def calculate_profit(
@@ -308,35 +674,12 @@ def calculate_profit(
 
 
 def player_active_offer(
-    offers_model: Any,
-    txs_model: Any,
+    session: SessionType,
     round: int,
     pid: PlayerIdentifier,
-    *,
-    traded_players: set[PlayerIdentifier] | None = None,
-) -> tuple[UUID, Offer] | None:
-    """Return the player's latest active offer from the durable offer ledger."""
-    latest = None
-
-    for entry_id, _, entry in um.filter_entries(offers_model, Offer, round=round):
-        if entry.pid == pid:
-            latest = (entry_id, entry)
-
-    if latest is None:
-        return None
-
-    entry_id, offer = latest
-
-    if offer.price is None:
-        return None
-
-    if traded_players is not None:
-        if pid in traded_players:
-            return None
-    elif player_has_traded(txs_model, round, pid):
-        return None
-
-    return entry_id, offer
+) -> tuple[UUID, int] | None:
+    """Return the ID and price of the player's active offer, if any."""
+    return get_book(session, round).active_offer(pid)
 
 
 def transaction_players(transaction: Transaction) -> tuple[PlayerIdentifier, ...]:
@@ -346,52 +689,28 @@ def transaction_players(transaction: Transaction) -> tuple[PlayerIdentifier, ...
     return (transaction.acceptor,)
 
 
-def players_traded_in_round(txs_model: Any, round: int) -> set[PlayerIdentifier]:
-    traded: set[PlayerIdentifier] = set()
-
-    for _, _, transaction in um.filter_entries(txs_model, Transaction, round=round):
-        traded.update(transaction_players(transaction))
-
-    return traded
-
-
-def player_transaction_id(
-    txs_model: Any, round: int, pid: PlayerIdentifier
-) -> UUID | None:
-    result = player_transaction(txs_model, round, pid)
-
-    return result[0] if result is not None else None
-
-
 def player_transaction(
-    txs_model: Any,
+    session: SessionType,
     round: int,
     pid: PlayerIdentifier,
-) -> tuple[UUID, Transaction] | None:
-    for tx_id, _, transaction in um.filter_entries(txs_model, Transaction, round=round):
-        if pid in transaction_players(transaction):
-            return tx_id, transaction
-
-    return None
+) -> tuple[UUID, int] | None:
+    """Return the ID and price of the player's transaction, if any."""
+    return get_book(session, round).traded.get(pid)
 
 
-def player_has_traded(txs_model: Any, round: int, pid: PlayerIdentifier) -> bool:
-    for _, _, transaction in um.filter_entries(txs_model, Transaction, round=round):
-        if pid in transaction_players(transaction):
-            return True
-
-    return False
+def player_has_traded(session: SessionType, round: int, pid: PlayerIdentifier) -> bool:
+    return pid in get_book(session, round).traded
 
 
 def player_profit_from_ledger(player: PlayerType) -> int | None:
-    result = player_transaction(player.session.txs, player.round, player.pid)
+    result = player_transaction(player.session, player.round, player.pid)
 
     if result is None:
         return None
 
-    _, transaction = result
+    _, price = result
 
-    return calculate_profit(player, transaction.price, player.round)
+    return calculate_profit(player, price, player.round)
 
 
 def ensure_trading_open(player: PlayerType) -> None:
@@ -410,38 +729,486 @@ def ensure_trading_open(player: PlayerType) -> None:
         raise ValueError("Trading is closed for this round")
 
 
+class DiffCoalescer:
+    """
+    Merge the market diffs of one session within a broadcast window
+
+    All diffs queued within the window are sent as a single MarketDiff. An offer
+    that is added and removed again within the same window is dropped from
+    both lists, so the other participants never see it.
+
+    Attributes:
+        diffs: Number of diffs queued since the session started
+        sent: Number of MarketDiff messages sent (one per recipient)
+        saved: Number of messages avoided by merging
+    """
+
+    def __init__(self, session: SessionType) -> None:
+        self.session = session
+        self.where: int | None = None  # Page of the first sender, see notify
+        self.round: int | None = None
+        self.queued = 0
+        self.remove: list[UUID] = []
+        self.add: dict[UUID, dict[str, Any]] = {}
+        self.txs: list[dict[str, Any]] = []
+        self.scheduled = False
+
+        self.diffs = 0
+        self.sent = 0
+        self.saved = 0
+
+    def queue(
+        self,
+        sender: PlayerType,
+        round: int,
+        remove: list[UUID],
+        add: list[dict[str, Any]],
+        txs: list[dict[str, Any]],
+    ) -> None:
+        if self.round is not None and self.round != round:
+            self.flush()
+
+        if self.where is None:
+            self.where = sender.show_page
+
+        self.round = round
+        self.queued += 1
+        self.diffs += 1
+
+        for offer_id in remove:
+            if self.add.pop(offer_id, None) is None:
+                self.remove.append(offer_id)
+
+        for offer in add:
+            self.add[offer["id"]] = offer
+
+        self.txs.extend(txs)
+
+    def flush(self) -> None:
+        if self.queued == 0 or self.round is None:
+            return
+
+        where, round, queued = self.where, self.round, self.queued
+        remove, add, txs = self.remove, list(self.add.values()), self.txs
+
+        recipients = self.session.players
+        book = get_book(self.session, round)
+
+        if remove or add or txs:
+            diff = book.record_diff(remove, add, txs)
+        else:
+            # Everything queued cancelled out, so the book is as of seq again
+            book.settle()
+
+        # Only cleared once recorded: from here on get_market serves the diff to
+        # anyone who misses it, so a failed send below does not lose it
+        self.where = self.round = None
+        self.queued = 0
+        self.remove, self.add, self.txs = [], {}, []
+
+        if not (remove or add or txs):
+            self.saved += queued * len(recipients)
+
+            return
+
+        started = perf_counter()
+        notify(self.session, recipients, diff, event="MarketDiff", where=where)
+        stats = round_stats(self.session, round)
+
+        if stats is not None:
+            stats.fanout_ms.append((perf_counter() - started) * 1000)
+
+        self.sent += len(recipients)
+        self.saved += (queued - 1) * len(recipients)
+
+    async def flush_later(self, window: float) -> None:
+        await asyncio.sleep(window)
+
+        self.scheduled = False
+
+        with self.session:
+            self.flush()
+
+
+_coalescers: dict[str, DiffCoalescer] = {}
+
+
+def get_coalescer(session: SessionType) -> DiffCoalescer:
+    key = str(session.offers)
+
+    if key not in _coalescers:
+        _coalescers[key] = DiffCoalescer(session)
+
+    return _coalescers[key]
+
+
 def broadcast_market_diff(
     sender: PlayerType,
     session: SessionType,
+    round: int,
     remove: list[UUID],
     add: list[dict[str, Any]],
     txs: list[dict[str, Any]],
 ) -> None:
-    """Send a minimal market diff to all participants."""
-    notify(
-        sender,
-        session.players,
-        {"remove": remove, "add": add, "txs": txs},
-        event="MarketDiff",
-    )
+    """
+    Send a minimal, sequence-numbered market diff to all participants
+
+    Diffs are merged over the session's broadcast window (in milliseconds)
+    before they are sent.
+    """
+    coalescer = get_coalescer(session)
+    coalescer.queue(sender, round, remove, add, txs)
+
+    window = session_setting(session, "broadcast_window") / 1000
+
+    if window <= 0:
+        coalescer.flush()
+    elif not coalescer.scheduled:
+        coalescer.scheduled = True
+        spawn(coalescer.flush_later(window))
 
 
 def create_offer_entry(
     session: SessionType,
-    player: PlayerType | PlayerIdentifier,
+    pid: PlayerIdentifier,
     round: int,
     is_buy: bool,
     price: int | None,
 ) -> UUID:
     """Helper to create and store an offer, returns the entry UUID"""
-    return um.add_entry(
+    offer_id = um.add_entry(
         session.offers,
-        cast(PlayerIdentifier, player),
+        pid,
         Offer,
         round=round,
         buy=is_buy,
         price=price,
     )
+    get_book(session, round).apply_offer(offer_id, pid, is_buy, price)
+
+    return offer_id
+
+
+def create_transaction_entry(
+    session: SessionType,
+    round: int,
+    acceptor: PlayerIdentifier,
+    proposer: PlayerIdentifier,
+    price: int,
+) -> UUID:
+    """Helper to create and store a transaction, returns the entry UUID"""
+    tx_id = um.add_entry(
+        session.txs,
+        acceptor,
+        Transaction,
+        round=round,
+        acceptor=acceptor,
+        price=price,
+        proposer=proposer,
+    )
+    get_book(session, round).apply_transaction(tx_id, price, (acceptor, proposer))
+
+    return tx_id
+
+
+class Matcher:
+    """
+    Per-session matching loop
+
+    When the `matching_loop` setting is enabled, every offer, cancellation and
+    acceptance of a session is queued here and applied to the in-memory book
+    strictly in arrival order by a single task. Callers await their result.
+    Operations that are waiting together are processed as one batch within a
+    single session context. Their ledger entries are still written one by one,
+    as each operation adds them. The task ends when the queue is empty and is
+    started again by the next submit.
+    """
+
+    def __init__(self, session: SessionType) -> None:
+        self.session = session
+        self.queue: asyncio.Queue[tuple[Callable[[], Any], asyncio.Future[Any]]] = (
+            asyncio.Queue()
+        )
+        self.running = False
+
+    async def submit(self, operation: Callable[[], Any]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((operation, future))
+
+        if not self.running:
+            self.running = True
+            spawn(self.run())
+
+        return await future
+
+    async def run(self) -> None:
+        batch: list[tuple[Callable[[], Any], asyncio.Future[Any]]] = []
+
+        try:
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            with self.session:
+                for operation, future in batch:
+                    if future.done():
+                        continue
+
+                    try:
+                        future.set_result(operation())
+                    except Exception as e:
+                        future.set_exception(e)
+        except BaseException as e:
+            # Nobody else resolves the futures of the failed batch
+            for _, future in batch:
+                if future.done():
+                    continue
+
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                else:
+                    future.cancel()
+
+            raise
+        finally:
+            self.running = False
+
+            if not self.queue.empty():
+                self.running = True
+                spawn(self.run())
+
+
+_matchers: dict[str, Matcher] = {}
+
+
+def get_matcher(session: SessionType) -> Matcher:
+    key = str(session.offers)
+
+    if key not in _matchers:
+        _matchers[key] = Matcher(session)
+
+    return _matchers[key]
+
+
+@contextmanager
+def timed_call(player: PlayerType, method: str) -> Iterator[None]:
+    """Record the duration and outcome of a live call in the round's stats"""
+    stats = round_stats(player.session, player.round)
+
+    if stats is None:
+        yield
+
+        return
+
+    started = perf_counter()
+    ok = False
+
+    try:
+        yield
+        ok = True
+    finally:
+        stats.record_call(method, (perf_counter() - started) * 1000, ok)
+
+
+def load_stats(session: SessionType) -> list[dict[str, Any]]:
+    """Per-round ledger sizes and load statistics, e.g., for benchmarking"""
+    if session.get("offers") is None:
+        return []
+
+    rows = []
+
+    for round_num in range(1, cast(int, session_setting(session, "num_rounds")) + 1):
+        entries, aggregates = round_summary(session, round_num)
+        stats = _stats.get(_book_key(session, round_num)) or RoundStats()
+
+        rows.append(
+            {
+                "round": round_num,
+                "ledger_size": entries,
+                "transactions": len(aggregates["transactions"]),
+                **stats.summary(),
+            }
+        )
+
+    return rows
+
+
+async def run_serialized(session: SessionType, operation: Callable[[], Any]) -> Any:
+    """Run a market operation, through the session's matching loop if enabled"""
+    if session_setting(session, "matching_loop"):
+        return await get_matcher(session).submit(operation)
+
+    return operation()
+
+
+def place_offer(player: PlayerType, amount: int | None) -> int | None:
+    """Validate and record a new offer (or cancellation) by the player"""
+    ensure_trading_open(player)
+
+    can_offer_key = "buyer_can_offer" if player.buyer else "seller_can_offer"
+
+    if not session_setting(player.session, can_offer_key):
+        raise ValueError("Your role cannot make offers in this market")
+
+    if player_has_traded(player.session, player.round, player.pid):
+        raise ValueError(f"Player {player} already traded.")
+
+    if amount is not None:
+        if not is_integer(amount):
+            raise ValueError("Offer amount must be an integer")
+
+        if amount < 0:
+            raise ValueError(f"Bad amount: {amount}")
+
+        session = player.session
+        cost_or_value = cast(int, player.cost_or_value)
+
+        if player.buyer:
+            max_bid = cost_or_value - get_tax(session, "buyer_tax", player.round)
+
+            if amount > max_bid:
+                raise ValueError("Bid cannot exceed your valuation minus tax")
+        else:
+            min_ask = cost_or_value + get_tax(session, "seller_tax", player.round)
+
+            if amount < min_ask:
+                raise ValueError("Ask cannot be below your cost plus tax")
+
+    active_offer = player_active_offer(player.session, player.round, player.pid)
+    old_offer_id = active_offer[0] if active_offer is not None else None
+
+    player.offer = create_offer_entry(
+        player.session,
+        player.pid,
+        player.round,
+        player.buyer,
+        amount,
+    )
+
+    broadcast_market_diff(
+        player,
+        player.session,
+        player.round,
+        remove=[old_offer_id] if old_offer_id is not None else [],
+        add=(
+            [{"id": player.offer, "price": amount, "buy": player.buyer}]
+            if amount is not None
+            else []
+        ),
+        txs=[],
+    )
+
+    return amount
+
+
+def execute_accept(player: PlayerType, offer_ids: list[Any]) -> int:
+    """Accept the first still-valid offer among offer_ids for the player"""
+    ensure_trading_open(player)
+
+    book = get_book(player.session, player.round)
+
+    if player.pid in book.traded:
+        raise ValueError(f"Player {player} already traded.")
+
+    # Try each candidate until we find one still valid
+    offer_id: UUID | None = None
+    offer: tuple[PlayerIdentifier, bool, int] | None = None
+
+    for raw_id in offer_ids:
+        cid = UUID(str(raw_id))
+        candidate = book.active.get(cid)
+
+        if candidate is None:
+            continue
+
+        candidate_pid, candidate_buy, _ = candidate
+
+        if candidate_buy == player.buyer:
+            continue
+
+        if candidate_pid == player.pid:
+            continue
+
+        offer_id = cid
+        offer = candidate
+        break
+
+    if offer_id is None or offer is None:
+        raise ValueError("Offer no longer valid")
+
+    # Ensure accepting this offer wouldn't yield negative profit
+    session = player.session
+    offer_pid, _, offer_price = offer
+
+    if player.buyer:
+        tax = get_tax(session, "buyer_tax", player.round)
+
+        if offer_price > cast(int, player.cost_or_value) - tax:
+            raise ValueError("Accepting this offer would result in negative profit")
+    else:
+        tax = get_tax(session, "seller_tax", player.round)
+
+        if offer_price < cast(int, player.cost_or_value) + tax:
+            raise ValueError("Accepting this offer would result in negative profit")
+
+    # Capture acceptor's active offer ID before cancellation.
+    acceptor_active_offer = book.active_offer(player.pid)
+    acceptor_old_offer_id = (
+        acceptor_active_offer[0] if acceptor_active_offer is not None else None
+    )
+
+    # Cancel proposer's offer to prevent double-trading
+    create_offer_entry(
+        player.session,
+        offer_pid,
+        player.round,
+        not player.buyer,  # Opposite side (double auction mechanics)
+        None,  # Null price cancels
+    )
+
+    # Update proposer
+    with Player(offer_pid.sname, offer_pid.uname) as proposer:
+        proposer.offer = None
+        proposer.profit = calculate_profit(proposer, offer_price, player.round)
+        notify(player, proposer, [True, proposer.profit], event="OfferAccepted")
+
+        # Update acceptor
+        player.offer = None
+        player.profit = calculate_profit(player, offer_price, player.round)
+
+        # Cancel any outstanding offer by acceptor
+        create_offer_entry(
+            player.session,
+            player.pid,
+            player.round,
+            player.buyer,
+            None,  # Null price cancels
+        )
+
+        # Record transaction
+        tx_id = create_transaction_entry(
+            player.session,
+            player.round,
+            acceptor=player.pid,
+            proposer=offer_pid,
+            price=offer_price,
+        )
+        proposer.trade = player.trade = tx_id
+
+    remove_ids = [offer_id]
+
+    if acceptor_old_offer_id is not None:
+        remove_ids.append(acceptor_old_offer_id)
+
+    broadcast_market_diff(
+        player,
+        player.session,
+        player.round,
+        remove=remove_ids,
+        add=[],
+        txs=[{"price": offer_price}],
+    )
+
+    return cast(int, player.profit)
 
 
 class Instructions(Page):
@@ -453,7 +1220,7 @@ class Instructions(Page):
 
     @classmethod
     def show(page, player: PlayerType) -> bool:
-        return bool(player.present)
+        return bool(player.get("present", False))
 
 
 class RoundInfo(Page):
@@ -461,7 +1228,7 @@ class RoundInfo(Page):
 
     @classmethod
     def show(page, player: PlayerType) -> bool:
-        return bool(player.present)
+        return bool(player.get("present", False))
 
 
 class Trade(Page):
@@ -475,7 +1242,7 @@ class Trade(Page):
 
     @classmethod
     def show(page, player: PlayerType) -> bool:
-        return bool(player.present)
+        return bool(player.get("present", False))
 
     @classmethod
     def before_once(page, player: PlayerType) -> None:
@@ -496,37 +1263,71 @@ class Trade(Page):
 
         return float(session.trade_until - time())
 
+    @classmethod
+    def after_always_once(page, player: PlayerType) -> None:
+        end_round(player.session, player.round)
+
     @classmethod
     async def jsvars(page, player: PlayerType) -> dict[str, Any]:
+        session = player.session
         can_offer_key = "buyer_can_offer" if player.buyer else "seller_can_offer"
-        can_offer = session_setting(player.session, can_offer_key)
+        can_offer = session_setting(session, can_offer_key)
+        result = player_active_offer(session, player.round, player.pid)
+        offer_amount = result[1] if result is not None else None
+
+        if not session._uproot_simulate:
+            return dict(offer_amount=offer_amount, can_offer=can_offer)
+
+        # Parameters for the zero-intelligence traders in simulate.js and benchmark.py
+        values = session_setting(session, "values")
+        costs = session_setting(session, "costs")
+        zip_share = session_setting(session, "simulate_zip_share")
+        tax_key = "buyer_tax" if player.buyer else "seller_tax"
+        tax = get_tax(session, tax_key, player.round)
+        cost_or_value = cast(int, player.cost_or_value)
+
+        return dict(
+            offer_amount=offer_amount,
+            can_offer=can_offer,
+            simulate=dict(
+                buyer=player.buyer,
+                limit=cost_or_value - tax if player.buyer else cost_or_value + tax,
+                strategy="zip" if rng().random() < zip_share else "zic",
+                interval=session_setting(session, "simulate_interval"),
+                price_ceiling=max(values + costs),
+            ),
+        )
 
-        traded_players = players_traded_in_round(player.session.txs, player.round)
+    @live
+    def get_market(page, player: PlayerType, since: int | None = None) -> Any:
+        """
+        Return the market book, or only the diffs a client has missed
 
-        if player.pid in traded_players:
-            return dict(offer_amount=None, can_offer=can_offer)
+        Args:
+            since: Sequence number of the last diff the client applied
 
-        result = player_active_offer(
-            player.session.offers,
-            player.session.txs,
-            player.round,
-            player.pid,
-            traded_players=traded_players,
-        )
+        Returns:
+            {'seq', 'diffs'} if the missed diffs are still buffered, otherwise
+            a full snapshot as returned by market_data
 
-        if result is None:
-            return dict(offer_amount=None, can_offer=can_offer)
+        Changes still waiting in the broadcast window are not included. They
+        reach the caller with everyone else's MarketDiff when the window ends.
+        """
+        with timed_call(player, "get_market"):
+            if since is not None:
+                if not is_integer(since):
+                    raise ValueError("since must be an integer")
 
-        _, offer = result
+                book = get_book(player.session, player.round)
+                diffs = book.diffs_since(since)
 
-        return dict(offer_amount=offer.price, can_offer=can_offer)
+                if diffs is not None:
+                    return {"seq": book.seq, "diffs": diffs}
 
-    @live
-    def get_market(page, player: PlayerType) -> dict[str, list[dict[str, Any]]]:
-        return market_data(player.session.offers, player.session.txs, player.round)
+            return market_data(player.session, player.round)
 
     @live
-    def make_offer(page, player: PlayerType, amount: int | None) -> int | None:
+    async def make_offer(page, player: PlayerType, amount: int | None) -> int | None:
         """
         Submit a new bid (buyers) or ask (sellers) to the market
 
@@ -539,207 +1340,69 @@ class Trade(Page):
         Raises:
             ValueError: If amount is negative or player already traded
         """
-        ensure_trading_open(player)
-
-        can_offer_key = "buyer_can_offer" if player.buyer else "seller_can_offer"
-
-        if not session_setting(player.session, can_offer_key):
-            raise ValueError("Your role cannot make offers in this market")
-
-        if player_has_traded(player.session.txs, player.round, player.pid):
-            raise ValueError(f"Player {player} already traded.")
-
-        if amount is not None:
-            if not is_integer(amount):
-                raise ValueError("Offer amount must be an integer")
-
-            if amount < 0:
-                raise ValueError(f"Bad amount: {amount}")
-
-            session = player.session
-            cost_or_value = cast(int, player.cost_or_value)
-
-            if player.buyer:
-                max_bid = cost_or_value - get_tax(session, "buyer_tax", player.round)
-
-                if amount > max_bid:
-                    raise ValueError("Bid cannot exceed your valuation minus tax")
-            else:
-                min_ask = cost_or_value + get_tax(session, "seller_tax", player.round)
-
-                if amount < min_ask:
-                    raise ValueError("Ask cannot be below your cost plus tax")
-
-        active_offer = player_active_offer(
-            player.session.offers,
-            player.session.txs,
-            player.round,
-            player.pid,
-            traded_players=players_traded_in_round(player.session.txs, player.round),
-        )
-        old_offer_id = active_offer[0] if active_offer is not None else None
-
-        player.offer = create_offer_entry(
-            player.session,
-            player,
-            player.round,
-            player.buyer,
-            amount,
-        )
-
-        broadcast_market_diff(
-            player,
-            player.session,
-            remove=[old_offer_id] if old_offer_id is not None else [],
-            add=(
-                [{"id": player.offer, "price": amount, "buy": player.buyer}]
-                if amount is not None
-                else []
-            ),
-            txs=[],
-        )
-
-        return amount
+        with timed_call(player, "make_offer"):
+            return cast(
+                int | None,
+                await run_serialized(
+                    player.session, lambda: place_offer(player, amount)
+                ),
+            )
 
     @live
-    def accept_offer(page, player: PlayerType, offer_ids: list[Any]) -> int:
+    async def accept_offer(page, player: PlayerType, offer_ids: list[Any]) -> int:
         """
         Accept an existing market offer, executing a trade
 
         The client sends a list of offer IDs (all at the same price);
         the server picks the first one that is still valid.
         """
-        ensure_trading_open(player)
-
-        # Pre-compute lookup state to avoid rescanning per candidate
-        traded_players = players_traded_in_round(player.session.txs, player.round)
-
-        if player.pid in traded_players:
-            raise ValueError(f"Player {player} already traded.")
-
-        player_latest: dict[PlayerIdentifier, UUID] = {}
-        offers_by_id: dict[UUID, Offer] = {}
-
-        for entry_id, _, entry in um.filter_entries(
-            player.session.offers, Offer, round=player.round
-        ):
-            player_latest[entry.pid] = entry_id
-            offers_by_id[entry_id] = entry
-
-        # Try each candidate until we find one still valid
-        offer_id: UUID | None = None
-        offer: Offer | None = None
-
-        for raw_id in offer_ids:
-            cid = UUID(str(raw_id))
-            candidate = offers_by_id.get(cid)
-
-            if candidate is None or candidate.price is None:
-                continue
-
-            if player_latest.get(candidate.pid) != cid:
-                continue
+        with timed_call(player, "accept_offer"):
+            return cast(
+                int,
+                await run_serialized(
+                    player.session, lambda: execute_accept(player, offer_ids)
+                ),
+            )
 
-            if candidate.pid in traded_players:
-                continue
+    @live
+    def report_latency(
+        page, player: PlayerType, samples: dict[str, list[float]]
+    ) -> None:
+        """Collect live-call round-trip times measured by simulated traders"""
+        stats = round_stats(player.session, player.round)
 
-            if candidate.buy == player.buyer:
-                continue
+        if stats is None:
+            return
 
-            if candidate.pid == player.pid:
+        for method, values in samples.items():
+            if method not in C.LIVE_METHODS or not isinstance(values, list):
                 continue
 
-            offer_id = cid
-            offer = candidate
-            break
-
-        if offer_id is None or offer is None:
-            raise ValueError("Offer no longer valid")
-
-        # Ensure accepting this offer wouldn't yield negative profit
-        session = player.session
-        offer_price = offer.price
-
-        if offer_price is None:
-            raise ValueError("Offer no longer valid")
-
-        if player.buyer:
-            tax = get_tax(session, "buyer_tax", player.round)
-
-            if offer_price > cast(int, player.cost_or_value) - tax:
-                raise ValueError("Accepting this offer would result in negative profit")
-        else:
-            tax = get_tax(session, "seller_tax", player.round)
-
-            if offer_price < cast(int, player.cost_or_value) + tax:
-                raise ValueError("Accepting this offer would result in negative profit")
-
-        # Capture acceptor's active offer ID before cancellation.
-        acceptor_active_offer = player_active_offer(
-            player.session.offers,
-            player.session.txs,
-            player.round,
-            player.pid,
-            traded_players=traded_players,
-        )
-        acceptor_old_offer_id = (
-            acceptor_active_offer[0] if acceptor_active_offer is not None else None
-        )
-
-        # Cancel proposer's offer to prevent double-trading
-        create_offer_entry(
-            player.session,
-            offer.pid,
-            player.round,
-            not player.buyer,  # Opposite side (double auction mechanics)
-            None,  # Null price cancels
-        )
-
-        # Update proposer
-        with Player(offer.pid.sname, offer.pid.uname) as proposer:
-            proposer.offer = None
-            proposer.profit = calculate_profit(proposer, offer_price, player.round)
-            notify(player, proposer, [True, proposer.profit], event="OfferAccepted")
-
-            # Update acceptor
-            player.offer = None
-            player.profit = calculate_profit(player, offer_price, player.round)
-
-            # Cancel any outstanding offer by acceptor
-            create_offer_entry(
-                player.session,
-                player,
-                player.round,
-                player.buyer,
-                None,  # Null price cancels
-            )
-
-            # Record transaction
-            tx_id = um.add_entry(
-                player.session.txs,
-                cast(PlayerIdentifier, player),
-                Transaction,
-                round=player.round,
-                acceptor=player.pid,
-                price=offer_price,
-                proposer=offer.pid,
+            stats.record_client(
+                method,
+                [
+                    float(v)
+                    for v in values[: C.STATS_SAMPLES]
+                    if isinstance(v, (int, float)) and not isinstance(v, bool)
+                ],
             )
-            proposer.trade = player.trade = tx_id
 
-        remove_ids = [offer_id]
 
-        if acceptor_old_offer_id is not None:
-            remove_ids.append(acceptor_old_offer_id)
+@lru_cache(maxsize=256)
+def expected_equilibrium(
+    demand: tuple[int, ...], supply: tuple[int, ...]
+) -> dict[str, int] | None:
+    """Competitive equilibrium of the (tax-adjusted) schedules, computed once each"""
+    eq = find_equilibrium([Decimal(v) for v in demand], [Decimal(c) for c in supply])
 
-        broadcast_market_diff(
-            player,
-            player.session,
-            remove=remove_ids,
-            add=[],
-            txs=[{"price": offer_price}],
-        )
+    if eq is None or eq.quantity == 0:
+        return None
 
-        return cast(int, player.profit)
+    return {
+        "price_min": int(eq.price_min),
+        "price_max": int(eq.price_max),
+        "quantity": int(eq.quantity),
+    }
 
 
 def digest(session: SessionType) -> dict[str, Any]:
@@ -761,18 +1424,9 @@ def digest(session: SessionType) -> dict[str, Any]:
     demand_values.sort(reverse=True)
     supply_costs.sort()
 
-    def eq_to_dict(eq: Any) -> dict[str, int] | None:
-        if eq is None or eq.quantity == 0:
-            return None
-
-        return {
-            "price_min": int(eq.price_min),
-            "price_max": int(eq.price_max),
-            "quantity": int(eq.quantity),
-        }
-
     rounds_data: list[dict[str, Any]] = []
     num_rounds = cast(int, session_setting(session, "num_rounds"))
+    load = {row["round"]: row for row in load_stats(session)}
 
     for round_num in range(1, num_rounds + 1):
         # Tax-adjusted curves (micro 101: demand shifts down, supply shifts up)
@@ -781,56 +1435,58 @@ def digest(session: SessionType) -> dict[str, Any]:
         eff_demand = [v - buyer_tax for v in demand_values]
         eff_supply = [c + seller_tax for c in supply_costs]
 
-        expected_eq = eq_to_dict(
-            find_equilibrium(
-                [Decimal(v) for v in eff_demand],
-                [Decimal(c) for c in eff_supply],
-            )
-        )
-
-        traded: set[PlayerIdentifier] = set()
-        tx_prices: list[int] = []
-
-        for _, _, transaction in um.filter_entries(
-            session.txs, Transaction, round=round_num
-        ):
-            traded.update(transaction_players(transaction))
-            tx_prices.append(transaction.price)
-
-        player_offers: dict[PlayerIdentifier, tuple[bool, int | None]] = {}
-
-        for _, _, entry in um.filter_entries(session.offers, Offer, round=round_num):
-            player_offers[entry.pid] = (entry.buy, entry.price)
-
-        actual_bids: list[int] = []
-        actual_asks: list[int] = []
-
-        for pid, (is_buy, price) in player_offers.items():
-            if pid in traded or price is None:
-                continue
-
-            (actual_bids if is_buy else actual_asks).append(price)
-
-        actual_bids.sort(reverse=True)
-        actual_asks.sort()
-
         rounds_data.append(
             {
                 "round": round_num,
                 "demand_values": eff_demand,
                 "supply_costs": eff_supply,
-                "expected_eq": expected_eq,
-                "actual_bids": actual_bids,
-                "actual_asks": actual_asks,
-                "transactions": tx_prices,
+                "expected_eq": expected_equilibrium(
+                    tuple(eff_demand), tuple(eff_supply)
+                ),
+                **round_summary(session, round_num)[1],
+                "load": load.get(round_num),
             }
         )
 
+    coalescer = _coalescers.get(str(session.offers))
+
     return {
         "rounds_data": rounds_data,
+        "broadcast": (
+            {
+                "diffs": coalescer.diffs,
+                "sent": coalescer.sent,
+                "saved": coalescer.saved,
+            }
+            if coalescer is not None
+            else None
+        ),
     }
 
 
+async def api2(session: SessionType, request: Any) -> Any:
+    """Serve load statistics of simulated sessions (see benchmark.py)"""
+    if not session._uproot_simulate:
+        raise HTTPException(status_code=404, detail="Not a simulated session")
+
+    return JSONResponse(
+        {
+            "session": session.name,
+            "players": len(session.players),
+            "settings": {
+                key: session_setting(session, key)
+                for key in (
+                    "broadcast_window",
+                    "matching_loop",
+                    "simulate_zip_share",
+                    "simulate_interval",
+                )
+            },
+            "rounds": load_stats(session),
+        }
+    )
+
+
 def pipeline(session: SessionType) -> list[dict[str, Any]]:
     if session.get("offers") is None:
         return []
@@ -839,11 +1495,7 @@ def pipeline(session: SessionType) -> list[dict[str, Any]]:
     num_rounds = cast(int, session_setting(session, "num_rounds"))
 
     for round_num in range(1, num_rounds + 1):
-        transactions = transactions_by_id(session, round_num)
-        traded = {
-            pid for tx in transactions.values() for pid in transaction_players(tx)
-        }
-        latest_offers = latest_offer_by_player(session, round_num, traded=traded)
+        book = peek_book(session, round_num)
 
         for player in session.players:
             app_data = player.within(app=__name__)
@@ -852,9 +1504,8 @@ def pipeline(session: SessionType) -> list[dict[str, Any]]:
                 continue
 
             round_data = player.within(app=__name__, round=round_num)
-            trade_id = round_data.get("trade")
-            transaction = transactions.get(trade_id)
-            active_offer = latest_offers.get(player.pid)
+            transaction = book.traded.get(player.pid)
+            active_offer = book.active_offer(player.pid)
 
             rows.append(
                 {
@@ -865,8 +1516,8 @@ def pipeline(session: SessionType) -> list[dict[str, Any]]:
                     "cost_or_value": app_data.get("cost_or_value"),
                     "buyer_tax": get_tax(session, "buyer_tax", round_num),
                     "seller_tax": get_tax(session, "seller_tax", round_num),
-                    "active_offer": active_offer.price if active_offer else None,
-                    "trade_price": transaction.price if transaction else None,
+                    "active_offer": active_offer[1] if active_offer else None,
+                    "trade_price": transaction[1] if transaction else None,
                     "profit": round_data.get("profit"),
                 }
             )
@@ -874,38 +1525,6 @@ def pipeline(session: SessionType) -> list[dict[str, Any]]:
     return rows
 
 
-def latest_offer_by_player(
-    session: SessionType,
-    round_num: int,
-    *,
-    traded: set[PlayerIdentifier] | None = None,
-) -> dict[PlayerIdentifier, Offer]:
-    offers: dict[PlayerIdentifier, Offer] = {}
-
-    if traded is None:
-        traded = players_traded_in_round(session.txs, round_num)
-
-    for _, _, offer in um.filter_entries(session.offers, Offer, round=round_num):
-        offers[offer.pid] = offer
-
-    return {
-        pid: offer
-        for pid, offer in offers.items()
-        if offer.price is not None and pid not in traded
-    }
-
-
-def transactions_by_id(session: SessionType, round_num: int) -> dict[UUID, Transaction]:
-    return {
-        entry_id: transaction
-        for entry_id, _, transaction in um.filter_entries(
-            session.txs,
-            Transaction,
-            round=round_num,
-        )
-    }
-
-
 def page_order(player: PlayerType) -> list[Any]:
     return [
         RaiseHands,
@@ -165,17 +165,63 @@ function acceptOffer(ids) {
     });
 }
 
-uproot.onCustomEvent("MarketDiff", event => {
-    const diff = event.detail.data;
+function applyDiff(diff) {
     const removeSet = new Set(diff.remove.map(id => String(id)));
     market.asks = market.asks.filter(o => !removeSet.has(String(o.id)));
     market.bids = market.bids.filter(o => !removeSet.has(String(o.id)));
     for (const offer of diff.add) {
-        (offer.buy ? market.bids : market.asks).push({id: offer.id, price: offer.price});
+        const side = offer.buy ? market.bids : market.asks;
+        if (!side.some(o => String(o.id) === String(offer.id))) {
+            side.push({id: offer.id, price: offer.price});
+        }
     }
     for (const tx of diff.txs) {
         market.txs.push(tx);
     }
+    seq = diff.seq;
+}
+
+function syncMarket(invoke = uproot.invoke) {
+    // Diffs that arrive while a resync is in flight are held back and replayed
+    if (syncing) return;
+    syncing = true;
+
+    invoke("get_market", seq).then(result => {
+        if (result.diffs !== undefined) {
+            result.diffs.filter(diff => diff.seq > seq).forEach(applyDiff);
+        }
+        else {
+            market = {asks: result.asks, bids: result.bids, txs: result.txs};
+            seq = result.seq;
+        }
+    }).catch(err => console.error(err)).finally(() => {
+        syncing = false;
+
+        const pending = heldDiffs.filter(diff => diff.seq > seq);
+        heldDiffs = [];
+        pending.forEach(receiveDiff);
+        refreshDisplay();
+    });
+}
+
+function receiveDiff(diff) {
+    if (syncing) {
+        heldDiffs.push(diff);
+    }
+    else if (seq !== null && diff.seq <= seq) {
+        // Already reflected in the book
+    }
+    else if (diff.prev !== seq) {
+        heldDiffs.push(diff);
+        syncMarket();
+    }
+    else {
+        applyDiff(diff);
+    }
+}
+
+uproot.onCustomEvent("MarketDiff", event => {
+    receiveDiff(event.detail.data);
     refreshDisplay();
 });
 
@@ -185,10 +231,7 @@ uproot.onCustomEvent("OfferAccepted", event => {
 });
 
 uproot.onReady(() => {
-    uproot.invoke("get_market").then(newMarket => {
-        market = newMarket;
-        refreshDisplay();
-    });
+    syncMarket();
 
     // Prevent default form submission on Enter key in amount input
     const amountInput = I("amount");
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+# Docs are available at https://uproot.science/
+# Examples are available at https://github.com/mrpg/uproot-examples
+#
+# This example app is under the 0BSD license. You can use it freely and build on it
+# without any limitations and without any attribution. However, these two lines must be
+# preserved in any uproot app (the license file is automatically installed in projects):
+#
+# Third-party dependencies:
+# - uproot: LGPL v3+, see ../uproot_license.txt
+
+"""
+Double auction load benchmark
+
+Drives a simulated double_auction session on a running uproot server, collects its
+load statistics and compares benchmark runs against each other.
+
+Create a session with "Simulate responses" enabled (optionally setting
+`simulate_zip_share`, `simulate_interval`, `broadcast_window` and
+`matching_loop`). Then, from the project directory:
+
+    python double_auction/benchmark.py run http://127.0.0.1:8000 SESSION \
+        --api-key KEY -o run.json
+    python double_auction/benchmark.py compare baseline.json run.json
+
+`run` plays every participant of the session without a browser: it loads and
+submits the pages over HTTP and runs the ZI-C/ZIP traders of simulate.js over
+each participant's websocket, calling the same live methods. Pass `--players` to
+drive only some usernames (no API key needed), e.g., to split a large session
+across machines. Once all participants are done, it writes the per-round
+statistics (offers/sec, p50/p95/p99 live-call latency measured on the server and
+in the clients, broadcast fan-out time, ledger size).
+
+If the participant links are opened in browsers instead, `fetch` waits until the
+session's trading has gone quiet and writes the same statistics. `compare`
+prints the change of each metric and exits with status 1 if any got worse by
+more than the tolerance.
+
+This script only uses the standard library and websockets, which uproot depends
+on, and does not import uproot.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+from collections.abc import Callable
+from typing import Any
+
+import websockets
+from websockets.typing import Origin
+
+LATENCY_METHODS = ("make_offer", "accept_offer", "get_market")
+
+
+def fetch_stats(server: str, session: str) -> dict[str, Any]:
+    url = f"{server.rstrip('/')}/api2/double_auction/{session}/"
+
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return dict(json.load(response))
+
+
+def total_calls(stats: dict[str, Any]) -> int:
+    return sum(sum(row["calls"].values()) for row in stats["rounds"])
+
+
+def fetch(args: argparse.Namespace) -> None:
+    stats = fetch_stats(args.server, args.session)
+    calls = total_calls(stats)
+
+    # Wait until no live calls have arrived for a whole polling interval
+    while args.wait > 0:
+        time.sleep(args.wait)
+        stats = fetch_stats(args.server, args.session)
+
+        if total_calls(stats) == calls:
+            break
+
+        calls = total_calls(stats)
+
+    save_stats(stats, args.label or args.session, args.output)
+
+
+def save_stats(stats: dict[str, Any], label: str, output: str) -> None:
+    stats["label"] = label
+    stats["fetched"] = time.time()
+
+    with open(output, "w") as f:
+        json.dump(stats, f, indent=2)
+
+    print(
+        f"Wrote {total_calls(stats)} live calls over {len(stats['rounds'])} rounds "
+        f"to {output}"
+    )
+
+
+def metrics(stats: dict[str, Any]) -> dict[str, tuple[float, int]]:
+    """Flatten a run into {name: (value, direction)}, 1 if higher is better"""
+    result: dict[str, tuple[float, int]] = {}
+
+    for row in stats["rounds"]:
+        prefix = f"round {row['round']}"
+
+        if row.get("offers_per_sec") is not None:
+            result[f"{prefix} offers/sec"] = (row["offers_per_sec"], 1)
+
+        for source in ("server_ms", "client_ms"):
+            for method in LATENCY_METHODS:
+                p = row[source].get(method)
+
+                if p is None:
+                    continue
+
+                for q in ("p50", "p95", "p99"):
+                    result[f"{prefix} {method} {source[:-3]} {q} ms"] = (p[q], -1)
+
+        if row.get("fanout_ms") is not None:
+            for q in ("p50", "p95", "p99"):
+                result[f"{prefix} fan-out {q} ms"] = (row["fanout_ms"][q], -1)
+
+        # Informational only: the ledger grows with the activity of the traders
+        result[f"{prefix} ledger size"] = (row["ledger_size"], 0)
+
+    return result
+
+
+def compare(args: argparse.Namespace) -> None:
+    with open(args.baseline) as f:
+        baseline = metrics(json.load(f))
+
+    with open(args.candidate) as f:
+        candidate = metrics(json.load(f))
+
+    regressions = 0
+    width = max((len(name) for name in baseline), default=0)
+
+    for name, (old, direction) in baseline.items():
+        if name not in candidate:
+            continue
+
+        new = candidate[name][0]
+        change = (new - old) / old if old else 0.0
+        flag = ""
+
+        if -direction * change > args.tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        print(f"{name:<{width}}  {old:>10.2f}  {new:>10.2f}  {change:>+8.1%}{flag}")
+
+    if regressions:
+        print(f"\n{regressions} metric(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+class Participant:
+    """One participant link, loaded over HTTP and driven over its websocket"""
+
+    def __init__(self, server: str, session: str, uname: str) -> None:
+        self.server = server.rstrip("/")
+        self.session = session
+        self.uname = uname
+        self.url = f"{self.server}/p/{session}/{uname}/"
+        self.page: str | None = None
+        self.vars: dict[str, Any] = {}
+        self.futures: dict[int, asyncio.Future[Any]] = {}
+        self.counter = itertools.count(1)
+        self.listeners: dict[str, Callable[[Any], None]] = {}
+        self.ws: Any = None
+        self.reader: asyncio.Task[None] | None = None
+
+    @property
+    def internal(self) -> dict[str, Any]:
+        return dict(self.vars.get("_uproot_internal", {}))
+
+    def load(self, data: bytes | None = None) -> str | None:
+        """Load (or submit) the current page and return its path"""
+        with urllib.request.urlopen(self.url, data=data, timeout=30) as response:
+            html = response.read().decode()
+
+        found_vars = re.search(r"uproot\.vars = (\{.*?\});\n", html)
+        found_page = re.search(r'uproot\.currentPage = "(.*?)";', html)
+        self.vars = json.loads(found_vars.group(1)) if found_vars else {}
+        self.page = found_page.group(1) if found_page else None
+
+        return self.page
+
+    def submit(self) -> str | None:
+        internal = self.internal
+        form = {
+            "_uproot_from": str(internal["thisis"]),
+            "_uproot_csrf": f"{self.session}+{self.uname}+{internal['key']}",
+        }
+
+        return self.load(urllib.parse.urlencode(form).encode())
+
+    async def connect(self) -> None:
+        ws_url = "ws" + self.server.removeprefix("http")
+        self.ws = await websockets.connect(
+            f"{ws_url}/ws/{self.session}/{self.uname}/",
+            origin=Origin(self.server),
+            max_size=None,
+        )
+        self.reader = asyncio.create_task(self.receive())
+
+    async def receive(self) -> None:
+        async for message in self.ws:
+            data = json.loads(message)
+            kind, payload = data.get("kind"), data.get("payload")
+
+            if kind == "invoke" and "future" in payload:
+                future = self.futures.pop(payload["future"], None)
+
+                if future is None or future.done():
+                    continue
+
+                if payload["error"]:
+                    future.set_exception(RuntimeError("Server-side exception"))
+                else:
+                    future.set_result(payload["data"])
+            elif kind == "queue":
+                entry = payload["entry"]
+
+                # Like uproot.js, ignore events meant for another page
+                if entry.get("constraint") not in (None, self.internal.get("thisis")):
+                    continue
+
+                listener = self.listeners.get(entry.get("event"))
+
+                if listener is not None:
+                    listener(entry["data"])
+
+    async def invoke(self, mname: str, *args: Any) -> Any:
+        future_id = next(self.counter)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[future_id] = future
+
+        await self.ws.send(
+            json.dumps(
+                {
+                    "endpoint": "invoke",
+                    "payload": {"mname": mname, "args": list(args), "kwargs": {}},
+                    "future": future_id,
+                }
+            )
+        )
+
+        return await future
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class Trader:
+    """
+    ZI-C or ZIP trader on the Trade page, as in simulate.js
+
+    The trader keeps its own copy of the market from MarketDiff events and
+    get_market, times every live call and reports the timings to the server.
+    """
+
+    def __init__(self, participant: Participant, params: dict[str, Any]) -> None:
+        self.participant = participant
+        self.params = params
+        self.buyer = bool(params["buyer"])
+        self.limit = int(params["limit"])
+        self.samples: dict[str, list[float]] = {m: [] for m in LATENCY_METHODS}
+        self.asks: dict[str, int] = {}
+        self.bids: dict[str, int] = {}
+        self.seq: int | None = None
+        self.stale = True
+        self.traded = False
+
+        # ZIP state
+        self.margin = 0.05 + random.random() * 0.3
+        self.change = 0.0
+        self.learning_rate = 0.1 + random.random() * 0.4
+        self.momentum = random.random() * 0.1
+
+    async def timed(self, method: str, *args: Any) -> Any:
+        started = time.perf_counter()
+
+        try:
+            return await self.participant.invoke(method, *args)
+        finally:
+            self.samples[method].append((time.perf_counter() - started) * 1000)
+
+    async def report(self) -> None:
+        if any(self.samples.values()):
+            samples, self.samples = self.samples, {m: [] for m in LATENCY_METHODS}
+            await self.participant.invoke("report_latency", samples)
+
+    def apply(self, diff: dict[str, Any]) -> None:
+        for offer_id in diff["remove"]:
+            self.asks.pop(offer_id, None)
+            self.bids.pop(offer_id, None)
+
+        for offer in diff["add"]:
+            (self.bids if offer["buy"] else self.asks)[offer["id"]] = offer["price"]
+
+        self.seq = diff["seq"]
+
+    def receive(self, diff: dict[str, Any]) -> None:
+        if self.params["strategy"] == "zip":
+            for tx in diff["txs"]:
+                self.learn(tx["price"], True, None)
+
+            for offer in diff["add"]:
+                self.learn(offer["price"], False, offer["buy"])
+
+        if self.stale or (self.seq is not None and diff["seq"] <= self.seq):
+            return
+        elif diff["prev"] != self.seq:
+            self.stale = True
+        else:
+            self.apply(diff)
+
+    async def sync(self) -> None:
+        since = self.seq
+        result = await self.timed("get_market", since)
+
+        if self.seq != since:
+            return  # A diff has been applied meanwhile, stay with that
+
+        if "diffs" in result:
+            for diff in result["diffs"]:
+                if self.seq is None or diff["seq"] > self.seq:
+                    self.apply(diff)
+        else:
+            self.asks = {o["id"]: o["price"] for o in result["asks"]}
+            self.bids = {o["id"]: o["price"] for o in result["bids"]}
+            self.seq = result["seq"]
+
+        self.stale = False
+
+    def quote(self) -> int:
+        factor = 1 - self.margin if self.buyer else 1 + self.margin
+
+        return max(0, round(self.limit * factor))
+
+    def learn(self, price: int, accepted: bool, shout_is_bid: bool | None) -> None:
+        current = self.quote()
+        target = None
+
+        if self.buyer:
+            if accepted and current >= price:
+                target = (
+                    price * random.uniform(0.95, 1)
+                    - random.uniform(0, 0.05) * self.limit
+                )
+            elif (accepted and current < price) or (
+                not accepted and shout_is_bid and current <= price
+            ):
+                target = (
+                    price * random.uniform(1, 1.05)
+                    + random.uniform(0, 0.05) * self.limit
+                )
+        else:
+            if accepted and current <= price:
+                target = (
+                    price * random.uniform(1, 1.05)
+                    + random.uniform(0, 0.05) * self.limit
+                )
+            elif (accepted and current > price) or (
+                not accepted and shout_is_bid is False and current >= price
+            ):
+                target = (
+                    price * random.uniform(0.95, 1)
+                    - random.uniform(0, 0.05) * self.limit
+                )
+
+        if target is None or self.limit <= 0:
+            return
+
+        self.change = self.momentum * self.change + (
+            1 - self.momentum
+        ) * self.learning_rate * (target - current)
+        following = current + self.change
+        self.margin = max(
+            0.0,
+            1 - following / self.limit if self.buyer else following / self.limit - 1,
+        )
+
+    async def act(self, tick: int) -> None:
+        if self.stale or tick % 5 == 0:
+            # Also exercise the resync path like a client after a reconnect would
+            await self.sync()
+
+        if self.params["strategy"] == "zip":
+            price = self.quote()
+        elif self.buyer:
+            price = random.randint(0, self.limit)
+        else:
+            price = random.randint(self.limit, self.params["price_ceiling"])
+
+        opposing = self.asks if self.buyer else self.bids
+        crossing = {
+            offer_id: offer_price
+            for offer_id, offer_price in opposing.items()
+            if (offer_price <= price if self.buyer else offer_price >= price)
+        }
+
+        if crossing:
+            best = (min if self.buyer else max)(crossing.values())
+            ids = [offer_id for offer_id, p in crossing.items() if p == best]
+
+            await self.timed("accept_offer", ids)
+            self.traded = True
+        elif self.participant.vars["can_offer"]:
+            await self.timed("make_offer", price)
+
+    async def trade(self, until: float) -> None:
+        self.participant.listeners["MarketDiff"] = self.receive
+        self.participant.listeners["OfferAccepted"] = lambda data: setattr(
+            self, "traded", bool(data[0])
+        )
+        interval = self.params["interval"] / 1000
+        reported = time.monotonic()
+        tick = 0
+
+        await asyncio.sleep(interval * random.random())
+
+        while not self.traded and time.monotonic() < until:
+            tick += 1
+
+            try:
+                await self.act(tick)
+            except RuntimeError:
+                pass  # Offers taken by others and closed rounds are expected here
+
+            if time.monotonic() - reported > 5:
+                await self.report()
+                reported = time.monotonic()
+
+            await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+
+        await self.report()
+
+
+async def participate(server: str, session: str, uname: str) -> None:
+    """Walk one participant through the pages of a simulated session"""
+    participant = Participant(server, session, uname)
+    page = await asyncio.to_thread(participant.load)
+    await participant.connect()
+
+    try:
+        while page != "End.html":
+            thisis = participant.internal["thisis"]
+            remaining = participant.internal.get("remaining_seconds") or 0.0
+
+            if page == "double_auction/RaiseHands":
+                await participant.invoke("set_presence", True)
+                await asyncio.sleep(remaining)
+            elif page == "double_auction/Trade":
+                until = time.monotonic() + remaining
+                await Trader(participant, participant.vars["simulate"]).trade(until)
+                # Stay on the page until the round ends, like a browser would
+                await asyncio.sleep(max(0.0, until - time.monotonic()))
+
+            page = await asyncio.to_thread(participant.submit)
+
+            if participant.internal["thisis"] == thisis:
+                await asyncio.sleep(1)  # Not allowed to proceed yet
+    finally:
+        await participant.close()
+
+
+def list_players(server: str, session: str, api_key: str) -> list[str]:
+    request = urllib.request.Request(
+        f"{server.rstrip('/')}/admin/api/v1/sessions/{session}/players/",
+        headers={"Authorization": f"Bearer {api_key}"},
+    )
+
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return list(json.load(response))
+
+
+async def run_participants(server: str, session: str, unames: list[str]) -> None:
+    await asyncio.gather(*(participate(server, session, u) for u in unames))
+
+
+def run(args: argparse.Namespace) -> None:
+    if args.players:
+        unames = args.players
+    elif args.api_key:
+        unames = list_players(args.server, args.session, args.api_key)
+    else:
+        sys.exit("Either --players or --api-key is required")
+
+    print(f"Running {len(unames)} participants")
+    asyncio.run(run_participants(args.server, args.session, unames))
+
+    stats = fetch_stats(args.server, args.session)
+    save_stats(stats, args.label or args.session, args.output)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(required=True)
+
+    fetch_parser = commands.add_parser("fetch", help="save a run's statistics")
+    fetch_parser.add_argument("server", help="e.g., http://127.0.0.1:8000")
+    fetch_parser.add_argument("session", help="name of the simulated session")
+    fetch_parser.add_argument("-o", "--output", default="double_auction_run.json")
+    fetch_parser.add_argument("--label", help="name of the run (default: session)")
+    fetch_parser.add_argument(
+        "--wait",
+        type=float,
+        default=10.0,
+        help="seconds between polls until trading is quiet (0: fetch once)",
+    )
+    fetch_parser.set_defaults(func=fetch)
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.10,
+        help="relative change that counts as a regression (default: 0.10)",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    run_parser = commands.add_parser(
+        "run", help="drive a simulated session headlessly, then save its statistics"
+    )
+    run_parser.add_argument("server", help="e.g., http://127.0.0.1:8000")
+    run_parser.add_argument("session", help="name of the simulated session")
+    run_parser.add_argument("--players", nargs="+", help="usernames to drive")
+    run_parser.add_argument(
+        "--api-key", help="admin API key, to drive all players of the session"
+    )
+    run_parser.add_argument("-o", "--output", default="double_auction_run.json")
+    run_parser.add_argument("--label", help="name of the run (default: session)")
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
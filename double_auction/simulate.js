@@ -10,9 +10,140 @@ uproot.simulate.on("double_auction/RoundInfo", (sim) => {
     sim.submit();
 });
 
+// Simulated traders follow one of two classic strategies:
+// - ZI-C (Gode & Sunder, 1993): random prices within the budget constraint
+// - ZIP (Cliff & Bruten, 1997): a profit margin adapted to the shouts in the market
+// They measure the round-trip time of every live call and report it to the
+// server, which aggregates it in the digest and for benchmark.py.
+
 uproot.simulate.on("double_auction/Trade", (sim) => {
-    if (canOffer) {
-        const amount = buyer ? costOrValue - tax : costOrValue + tax;
-        uproot.invoke("make_offer", amount);
+    const params = uproot.vars.simulate;
+    const limit = buyer ? costOrValue - tax : costOrValue + tax;
+    const samples = {make_offer: [], accept_offer: [], get_market: []};
+    let ticks = 0;
+
+    // ZIP state
+    let margin = 0.05 + Math.random() * 0.3;
+    let change = 0;
+    const learningRate = 0.1 + Math.random() * 0.4;
+    const momentum = Math.random() * 0.1;
+
+    function randomInt(min, max) {
+        return min + Math.floor(Math.random() * (max - min + 1));
+    }
+
+    function timed(method, ...args) {
+        const started = performance.now();
+
+        return uproot.invoke(method, ...args).finally(() => {
+            samples[method].push(performance.now() - started);
+        });
+    }
+
+    function report() {
+        if (Object.values(samples).some(values => values.length > 0)) {
+            // Passed as a keyword, since uproot.invoke turns a trailing object into kwargs
+            uproot.invoke("report_latency", {samples: {...samples}}).catch(() => {});
+            Object.keys(samples).forEach(method => samples[method] = []);
+        }
     }
+
+    function zipQuote() {
+        return Math.max(0, Math.round(buyer ? limit * (1 - margin) : limit * (1 + margin)));
+    }
+
+    function zipLearn(price, accepted, shoutIsBid) {
+        const current = zipQuote();
+        let target = null;
+
+        if (buyer) {
+            if (accepted && current >= price) {
+                target = price * (0.95 + Math.random() * 0.05) - Math.random() * 0.05 * limit;
+            }
+            else if ((accepted && current < price) || (!accepted && shoutIsBid && current <= price)) {
+                target = price * (1 + Math.random() * 0.05) + Math.random() * 0.05 * limit;
+            }
+        }
+        else {
+            if (accepted && current <= price) {
+                target = price * (1 + Math.random() * 0.05) + Math.random() * 0.05 * limit;
+            }
+            else if ((accepted && current > price) || (!accepted && !shoutIsBid && current >= price)) {
+                target = price * (0.95 + Math.random() * 0.05) - Math.random() * 0.05 * limit;
+            }
+        }
+
+        if (target === null || limit <= 0) return;
+
+        change = momentum * change + (1 - momentum) * learningRate * (target - current);
+        const next = current + change;
+        margin = Math.max(0, buyer ? 1 - next / limit : next / limit - 1);
+    }
+
+    function act() {
+        if (traded) {
+            report();
+            return;
+        }
+
+        ticks += 1;
+
+        const price = params.strategy === "zip"
+            ? zipQuote()
+            : (buyer ? randomInt(0, limit) : randomInt(limit, params.price_ceiling));
+        const opposing = buyer ? market.asks : market.bids;
+        const crossing = opposing.filter(o => buyer ? o.price <= price : o.price >= price);
+        let request = null;
+
+        if (crossing.length > 0) {
+            const prices = crossing.map(o => o.price);
+            const bestPrice = buyer ? Math.min(...prices) : Math.max(...prices);
+            const ids = crossing.filter(o => o.price === bestPrice).map(o => o.id);
+
+            request = timed("accept_offer", ids).then(profit_ => {
+                traded = true;
+                profit = profit_;
+                refreshDisplay();
+            });
+        }
+        else if (canOffer) {
+            request = timed("make_offer", price).then(newAmount => {
+                offerAmount = newAmount;
+                refreshDisplay();
+            });
+        }
+
+        if (ticks % 5 === 0) {
+            // Exercise the resync path like a client after a reconnect would
+            syncMarket(timed);
+        }
+
+        if (request !== null) {
+            request.catch(() => {
+                // Offers taken by others and closed rounds are expected here.
+            });
+        }
+
+        setTimeout(act, params.interval * (0.5 + Math.random()));
+    }
+
+    if (!params) {
+        if (canOffer) {
+            uproot.invoke("make_offer", limit);
+        }
+
+        return;
+    }
+
+    if (params.strategy === "zip") {
+        uproot.onCustomEvent("MarketDiff", event => {
+            const diff = event.detail.data;
+
+            diff.txs.forEach(tx => zipLearn(tx.price, true, null));
+            diff.add.forEach(offer => zipLearn(offer.price, false, offer.buy));
+        });
+    }
+
+    setInterval(report, 5000);
+    setTimeout(act, params.interval * Math.random());
 });
@@ -8,8 +8,14 @@
 # Third-party dependencies:
 # - uproot: LGPL v3+, see ../uproot_license.txt
 
+import asyncio
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
 from dataclasses import replace
 from decimal import Decimal
+from itertools import islice
+from time import monotonic
 from typing import Any
 
 import uproot.models as um
@@ -22,209 +28,888 @@ DESCRIPTION = "Continuous market (limit order book)"
 LANDING_PAGE = False
 
 
-class BookEvent(metaclass=um.Entry):
-    action: str
-    order_id: str
-    price: str
-    quantity: str
-    buy: bool
-    user: str
-    time: float
+class OrderEvents(metaclass=um.Entry):
+    """
+    Book changes and trades caused by one order or cancellation
 
+    Each instrument has its own ledger. Prices are in ticks and users are indices
+    into the instrument's list in session.market_users.
 
-class TradeEvent(metaclass=um.Entry):
-    buyer: str
-    seller: str
-    price: str
-    quantity: str
-    timestamp: float
+    Attributes:
+        book: [action (index into ACTIONS), order id, price, quantity, buy, user,
+            time] per changed order
+        trades: [buyer, seller, price, quantity, timestamp] per trade
+    """
 
+    book: list[list[Any]]
+    trades: list[list[Any]]
 
-_exchanges: dict[str, Exchange] = {}
 
+ACTIONS = ("add", "update", "remove")
 
-def _exchange_key(session: SessionType) -> str:
-    return str(session.book_model)
 
+class C:
+    DEFAULT_INSTRUMENTS = ["Stock"]  # Names of the assets traded side by side
+    DEFAULT_ORDER_RATE = 5  # Orders and cancellations per second of each trader
+    DEFAULT_ORDER_BURST = 20  # ... of which a trader may send this many at once
+    DEFAULT_SESSION_ORDER_RATE = 200  # Orders and cancellations per second overall
+    DEFAULT_SESSION_ORDER_BURST = 400
+    DEFAULT_UPDATE_INTERVAL = 100  # Milliseconds between MarketUpdates; 0: no limit
+    CHECKPOINT_EVENTS = 500  # Book events between two checkpoints of the book
+    RECENT_TRADES = 50  # Most recent trades kept in memory and in checkpoints
+    TICK = Decimal("0.01")  # Price increment; cash is kept as a number of ticks
+    FLUSH_INTERVAL = 1.0  # Seconds between writes of positions to player fields
+    ORDER_TYPES = ("limit", "market", "ioc", "fok")
+    MAX_ENGINES = 32  # Exchanges (one per instrument) kept in memory at most
+    ENGINE_TTL = 30 * 60  # Seconds without activity before an exchange is evicted
+    MEMORY_BUDGET = 500_000  # Resting orders and trades in memory across sessions
 
-def reconstruct_exchange(session: SessionType) -> Exchange:
-    exchange = Exchange()
 
-    if session.get("book_model") is None:
-        return exchange
+BookChange = tuple[str, Order]  # ("add" | "update" | "remove", order)
 
+
+def session_setting(session: SessionType, key: str) -> Any:
+    default = getattr(C, "DEFAULT_" + key.upper())
+
+    return get_setting(session, key, default)
+
+
+class PriceLevels:
+    """
+    Resting orders of one side of the book, aggregated by price
+
+    Kept up to date from the book changes of each order, so snapshots only
+    touch the levels they show.
+
+    Attributes:
+        descending: Whether the best price is the highest (bids)
+        prices: Sort keys of all levels, best first (negated prices for bids)
+        orders: Resting quantity per order id at each price, in time priority
+        quantities: Total resting quantity at each price
+    """
+
+    def __init__(self, descending: bool) -> None:
+        self.descending = descending
+        self.prices: list[Decimal] = []
+        self.orders: dict[Decimal, dict[str, int]] = {}
+        self.quantities: dict[Decimal, int] = {}
+
+    def _key(self, price: Decimal) -> Decimal:
+        return -price if self.descending else price
+
+    def _price(self, key: Decimal) -> Decimal:
+        return -key if self.descending else key
+
+    def apply(self, action: str, order: Order) -> None:
+        level = self.orders.get(order.price)
+
+        if level is None:
+            if action != "add":
+                return
+
+            level = self.orders[order.price] = {}
+            self.quantities[order.price] = 0
+            insort(self.prices, self._key(order.price))
+
+        previous = (
+            level.pop(order.id, 0) if action == "remove" else level.get(order.id, 0)
+        )
+
+        if action != "remove":
+            level[order.id] = int(order.quantity)
+
+        self.quantities[order.price] += level.get(order.id, 0) - previous
+
+        if not level:
+            del self.orders[order.price]
+            del self.quantities[order.price]
+            self.prices.pop(bisect_left(self.prices, self._key(order.price)))
+
+    def fillable(
+        self, quantity: int, limit: Decimal | None, excluded: dict[Decimal, int]
+    ) -> tuple[int, Decimal | None]:
+        """
+        Quantity an incoming order can fill up to limit (any price if None), and
+        the worst price it reaches, walking the levels from the best price
+
+        excluded is the quantity per price that cannot be filled (own orders).
+        """
+        filled, worst = 0, None
+
+        for key in self.prices:
+            if filled >= quantity or (limit is not None and key > self._key(limit)):
+                break
+
+            price = self._price(key)
+            available = self.quantities[price] - excluded.get(price, 0)
+
+            if available > 0:
+                filled += min(available, quantity - filled)
+                worst = price
+
+        return filled, worst
+
+    def best(self) -> Decimal | None:
+        return self._price(self.prices[0]) if self.prices else None
+
+    def snapshot(
+        self, depth: int | None = None, with_orders: bool = True
+    ) -> list[dict[str, Any]]:
+        """Best levels first: L2 (price, quantity) or L3 (also the orders)"""
+        levels = []
+
+        for key in islice(self.prices, depth):
+            price = self._price(key)
+            level: dict[str, Any] = {
+                "price": str(price),
+                "quantity": self.quantities[price],
+            }
+
+            if with_orders:
+                level["orders"] = [
+                    {"id": oid, "quantity": quantity}
+                    for oid, quantity in self.orders[price].items()
+                ]
+
+            levels.append(level)
+
+        return levels
+
+
+class Engine:
+    """
+    In-memory exchange of one instrument and how much of its ledger it reflects
+
+    Attributes:
+        instrument: Name of the instrument traded on this exchange
+        exchange: The mini-exchange holding the resting orders and recent trades
+        bids: Resting buy orders by price
+        asks: Resting sell orders by price
+        user_orders: Resting orders of each user by id
+        positions: Cash (in ticks) and units of each user from all their trades
+        dirty: Users whose positions have not been written to their fields yet
+        users: Names of all users that appear in the ledger, by user id
+        user_ids: User id of each name in users
+        entries: Number of OrderEvents entries applied to the exchange
+        book_events: Number of book changes applied to the exchange
+        checkpointed: Value of book_events when the last checkpoint was written
+        throttle: MarketUpdates of this exchange, once it has been traded on
+    """
+
+    def __init__(self, instrument: str = "") -> None:
+        self.instrument = instrument
+        self.exchange = Exchange()
+        self.bids = PriceLevels(descending=True)
+        self.asks = PriceLevels(descending=False)
+        self.user_orders: dict[str, dict[str, Order]] = {}
+        self.positions: dict[str, list[int]] = {}
+        self.dirty: set[str] = set()
+        self.users: list[str] = []
+        self.user_ids: dict[str, int] = {}
+        self.entries = 0
+        self.book_events = 0
+        self.checkpointed = 0
+        self.throttle: UpdateThrottle | None = None
+
+    def place(
+        self, price: Decimal, quantity: Decimal, user: str, buy: bool
+    ) -> tuple[Order, list[METrade], list[BookChange]]:
+        """
+        Place an order and return it, its trades and the changes to the book
+
+        mini-exchange keeps each side in price-time priority, so the resting
+        orders an incoming order can fill are at the front of the opposite side.
+        Only those are compared before and after matching.
+        """
+        opposite = self.exchange.asks if buy else self.exchange.bids
+        touched: list[Order] = []
+        available = Decimal(0)
+
+        for resting in opposite:
+            if available >= quantity or (
+                resting.price > price if buy else resting.price < price
+            ):
+                break
+
+            touched.append(resting)
+
+            if resting.user != user:
+                available += resting.quantity
+
+        order, trades = self.exchange.place(price, quantity, user, buy)
+        changes: list[BookChange] = []
+
+        for before in touched:
+            after = self.exchange.orders.get(before.id)
+
+            if after is None:
+                changes.append(("remove", before))
+            elif after.quantity != before.quantity:
+                changes.append(("update", after))
+
+        if order.id in self.exchange.orders:
+            changes.append(("add", self.exchange.orders[order.id]))
+
+        self.apply(changes)
+        self.trim_trades()
+
+        return order, trades, changes
+
+    def sweep(
+        self,
+        price: Decimal | None,
+        quantity: Decimal,
+        user: str,
+        buy: bool,
+        all_or_none: bool,
+    ) -> tuple[Order, list[METrade], list[BookChange]]:
+        """
+        Fill as much as possible up to price right away and never rest
+
+        Market orders have no price, immediate-or-cancel orders drop what they
+        cannot fill, and fill-or-kill orders (all_or_none) are rejected then.
+        """
+        levels = self.asks if buy else self.bids
+        own: dict[Decimal, int] = {}
+
+        for order in self.user_orders.get(user, {}).values():
+            if order.buy != buy:
+                own[order.price] = own.get(order.price, 0) + int(order.quantity)
+
+        filled, worst = levels.fillable(int(quantity), price, own)
+
+        if worst is None:
+            side = "sell" if buy else "buy"
+            at = "" if price is None else " at this price"
+
+            raise ValueError(f"No {side} orders available{at}")
+        if all_or_none and filled < quantity:
+            raise ValueError("Not enough orders available to fill the whole order")
+
+        # Priced at the worst level needed and sized to what is there, the
+        # order is filled completely and nothing is left to rest or cancel
+        return self.place(worst, Decimal(filled), user, buy)
+
+    def cancel(self, order_id: str) -> list[BookChange]:
+        order = self.exchange.orders[order_id]
+        self.exchange.cancel(order_id)
+        changes: list[BookChange] = [("remove", order)]
+        self.apply(changes)
+
+        return changes
+
+    def apply(self, changes: list[BookChange]) -> None:
+        for action, order in changes:
+            (self.bids if order.buy else self.asks).apply(action, order)
+            own = self.user_orders.setdefault(order.user, {})
+
+            if action == "remove":
+                own.pop(order.id, None)
+            else:
+                own[order.id] = order
+
+    def trim_trades(self) -> None:
+        """Only the most recent trades are shown, the rest are in the ledger"""
+        if len(self.exchange.trades) > 2 * C.RECENT_TRADES:
+            del self.exchange.trades[: -C.RECENT_TRADES]
+
+    def size(self) -> int:
+        return len(self.exchange.orders) + len(self.exchange.trades)
+
+    def settle(self, trades: Iterable[METrade]) -> None:
+        for trade in trades:
+            quantity = int(trade.quantity)
+            amount = int(trade.price / C.TICK) * quantity
+            buyer = self.positions.setdefault(trade.buyer, [0, 0])
+            seller = self.positions.setdefault(trade.seller, [0, 0])
+
+            buyer[0] -= amount
+            buyer[1] += quantity
+            seller[0] += amount
+            seller[1] -= quantity
+            self.dirty.update((trade.buyer, trade.seller))
+
+    def position(self, user: str) -> tuple[int, int]:
+        """Cash (in ticks) and units of this instrument a user has gained"""
+        cash, units = self.positions.get(user, (0, 0))
+
+        return cash, units
+
+    def user_id(self, user: str) -> int:
+        if user not in self.user_ids:
+            self.user_ids[user] = len(self.users)
+            self.users.append(user)
+
+        return self.user_ids[user]
+
+    def encode(
+        self, changes: list[BookChange], trades: list[METrade]
+    ) -> dict[str, list[list[Any]]]:
+        """Compact OrderEvents fields of the changes and trades of one order"""
+        return {
+            "book": [
+                [
+                    ACTIONS.index(action),
+                    o.id,
+                    int(o.price / C.TICK),
+                    0 if action == "remove" else int(o.quantity),
+                    o.buy,
+                    self.user_id(o.user),
+                    o.time,
+                ]
+                for action, o in changes
+            ],
+            "trades": [
+                [
+                    self.user_id(t.buyer),
+                    self.user_id(t.seller),
+                    int(t.price / C.TICK),
+                    int(t.quantity),
+                    t.timestamp,
+                ]
+                for t in trades
+            ],
+        }
+
+    def checkpoint(self) -> dict[str, Any]:
+        """Compact snapshot of the resting orders and the most recent trades"""
+        return {
+            "entries": self.entries,
+            "book_events": self.book_events,
+            "orders": [
+                [o.id, str(o.price), str(o.quantity), o.buy, o.user, o.time]
+                for o in self.exchange.orders.values()
+            ],
+            "trades": [
+                [t.buyer, t.seller, str(t.price), str(t.quantity), t.timestamp]
+                for t in self.exchange.trades[-C.RECENT_TRADES :]
+            ],
+            "positions": {user: list(p) for user, p in self.positions.items()},
+        }
+
+
+class EngineRegistry:
+    """
+    Engines of the instruments with recent activity, least recently used first
+
+    An engine is evicted when there are more than C.MAX_ENGINES, when all
+    engines together hold more than C.MEMORY_BUDGET orders and trades, or when
+    it has not been used for C.ENGINE_TTL seconds. It is rebuilt from the latest
+    checkpoint on its next use. Engines with positions that have not been written
+    to the traders' fields yet are kept until they are.
+    """
+
+    def __init__(self) -> None:
+        self.engines: OrderedDict[str, Engine] = OrderedDict()
+        self.used: dict[str, float] = {}
+        self.evicted: set[str] = set()
+
+        self.builds = 0
+        self.rebuilds = 0
+        self.evictions = 0
+
+    def get(self, key: str, build: Callable[[], Engine]) -> Engine:
+        now = monotonic()
+        engine = self.engines.get(key)
+
+        if engine is None:
+            engine = self.engines[key] = build()
+            self.builds += 1
+            self.rebuilds += key in self.evicted
+        else:
+            self.engines.move_to_end(key)
+
+        self.used[key] = now
+        self.evict(now, keep=key)
+
+        return engine
+
+    def evict(self, now: float, keep: str) -> None:
+        resident = self.resident()
+
+        for key in list(self.engines):
+            if (
+                len(self.engines) <= C.MAX_ENGINES
+                and resident <= C.MEMORY_BUDGET
+                and now - self.used[key] < C.ENGINE_TTL
+            ):
+                break
+
+            if key == keep or self.engines[key].dirty:
+                continue
+
+            resident -= self.engines.pop(key).size()
+            del self.used[key]
+            self.evicted.add(key)
+            self.evictions += 1
+
+    def resident(self) -> int:
+        return sum(engine.size() for engine in self.engines.values())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "engines": len(self.engines),
+            "resident": self.resident(),
+            "builds": self.builds,
+            "rebuilds": self.rebuilds,
+            "evictions": self.evictions,
+        }
+
+
+class TokenBucket:
+    """
+    Rate limit of a trader or a session
+
+    Holds up to burst tokens and gains rate tokens per second. Each order or
+    cancellation takes one, and is rejected if none is left.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.rejected = 0
+
+    def refill(self, now: float) -> bool:
+        """Add the tokens gained since the last call and tell whether one is left"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        return self.tokens >= 1
+
+
+class UpdateThrottle:
+    """
+    MarketUpdates of an instrument, sent at most once per update interval
+
+    Book changes and trades that arrive sooner are merged into one update that
+    is sent when the interval has passed. Its prev is the seq of the last update
+    sent, so clients apply it like any other.
+
+    Attributes:
+        sent: Number of MarketUpdates sent (one per update, not per recipient)
+        merged: Number of orders whose update was merged into a later one
+    """
+
+    def __init__(self, session: SessionType, engine: Engine) -> None:
+        self.session = session
+        self.engine = engine
+        self.where: int | None = None  # Page of the first sender, see notify
+        self.seq: int | None = None
+        self.changes: list[BookChange] = []
+        self.trades: list[METrade] = []
+        self.queued = 0
+        self.sent_at = 0.0
+        self.scheduled = False
+
+        self.sent = 0
+        self.merged = 0
+
+    def queue(
+        self, sender: PlayerType, changes: list[BookChange], trades: list[METrade]
+    ) -> None:
+        if self.where is None:
+            self.where = sender.show_page
+        if self.seq is None:
+            # The engine already counts the changes of this order
+            self.seq = self.engine.book_events - len(changes)
+
+        self.changes.extend(changes)
+        self.trades.extend(trades)
+        self.queued += 1
+
+    def flush(self) -> None:
+        if self.queued == 0:
+            return
+
+        engine = self.engine
+
+        with self.session:
+            watching = dict(self.session.get("watching") or {})
+
+        recipients = [
+            p for p in self.session.players if watching.get(p.name) == engine.instrument
+        ]
+
+        if recipients:
+            notify(
+                self.session,
+                recipients,
+                market_update(engine, cast(int, self.seq), self.changes, self.trades),
+                event="MarketUpdate",
+                where=self.where,
+            )
+
+        # Only cleared once sent, so that a failed send is retried with the next
+        self.sent += 1
+        self.merged += self.queued - 1
+
+        self.where = None
+        self.seq = engine.book_events
+        self.changes, self.trades = [], []
+        self.queued = 0
+        self.sent_at = monotonic()
+
+    async def flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        self.scheduled = False
+
+        with self.session:
+            self.flush()
+
+
+_exchanges = EngineRegistry()
+_flushes: set[str] = set()  # Sessions with a pending write of positions
+_buckets: dict[tuple[str, str | None], TokenBucket] = {}  # Per trader and session
+
+
+def book_model(session: SessionType, instrument: str) -> ModelIdentifier:
+    """Ledger of an instrument, whose name is at its index in session.book_models"""
+    mname = session.book_models[session.instruments.index(instrument)]
+
+    return ModelIdentifier(session.name, mname)
+
+
+def _exchange_key(session: SessionType, instrument: str) -> str:
+    return str(book_model(session, instrument))
+
+
+def instruments(session: SessionType) -> list[str]:
+    return list(session.get("instruments") or ())
+
+
+def restore_engine(
+    checkpoint: dict[str, Any] | None,
+    users: list[str],
+    entries: Iterable[Any],
+    instrument: str = "",
+) -> Engine:
+    """
+    Rebuild an engine from a checkpoint and the OrderEvents written after it
+
+    entries must start right after the entries covered by the checkpoint (or at
+    the beginning of the ledger if there is no checkpoint).
+    """
+    engine = Engine(instrument)
+    exchange = engine.exchange
     resting: dict[str, Order] = {}
-    for _, _, book_event in um.get_entries(session.book_model, BookEvent):
-        if book_event.action == "add":
-            order = Order(
-                id=book_event.order_id,
-                price=Decimal(book_event.price),
-                quantity=Decimal(book_event.quantity),
-                buy=book_event.buy,
-                user=book_event.user,
-                time=book_event.time,
+
+    for user in users:
+        engine.user_id(user)
+
+    if checkpoint is not None:
+        for oid, price, quantity, buy, user, time in checkpoint["orders"]:
+            resting[oid] = Order(
+                id=oid,
+                price=Decimal(price),
+                quantity=Decimal(quantity),
+                buy=buy,
+                user=user,
+                time=time,
             )
-            resting[book_event.order_id] = order
-        elif book_event.action == "remove":
-            resting.pop(book_event.order_id, None)
-        elif book_event.action == "update":
-            if book_event.order_id in resting:
-                old = resting[book_event.order_id]
-                resting[book_event.order_id] = replace(
-                    old, quantity=Decimal(book_event.quantity)
+
+        for buyer, seller, price, quantity, timestamp in checkpoint["trades"]:
+            exchange.trades.append(
+                METrade(
+                    buyer=buyer,
+                    seller=seller,
+                    price=Decimal(price),
+                    quantity=Decimal(quantity),
+                    timestamp=timestamp,
                 )
+            )
+
+        engine.positions = {
+            user: list(position) for user, position in checkpoint["positions"].items()
+        }
+        engine.entries = checkpoint["entries"]
+        engine.book_events = engine.checkpointed = checkpoint["book_events"]
+
+    for entry in entries:
+        for action, oid, price, quantity, buy, user, time in entry.book:
+            if ACTIONS[action] == "add":
+                resting[oid] = Order(
+                    id=oid,
+                    price=price * C.TICK,
+                    quantity=Decimal(quantity),
+                    buy=buy,
+                    user=users[user],
+                    time=time,
+                )
+            elif ACTIONS[action] == "remove":
+                resting.pop(oid, None)
+            elif oid in resting:
+                resting[oid] = replace(resting[oid], quantity=Decimal(quantity))
+
+        for buyer, seller, price, quantity, timestamp in entry.trades:
+            trade = METrade(
+                buyer=users[buyer],
+                seller=users[seller],
+                price=price * C.TICK,
+                quantity=Decimal(quantity),
+                timestamp=timestamp,
+            )
+            exchange.trades.append(trade)
+            engine.settle((trade,))
+
+        engine.trim_trades()
+
+        engine.entries += 1
+        engine.book_events += len(entry.book)
 
     for order in resting.values():
         side = exchange.bids if order.buy else exchange.asks
         side.add(order)
         exchange.orders[order.id] = order
 
-    if session.get("trade_model") is not None:
-        for _, _, trade_event in um.get_entries(session.trade_model, TradeEvent):
-            exchange.trades.append(
-                METrade(
-                    buyer=trade_event.buyer,
-                    seller=trade_event.seller,
-                    price=Decimal(trade_event.price),
-                    quantity=Decimal(trade_event.quantity),
-                    timestamp=trade_event.timestamp,
-                )
-            )
+    engine.apply(
+        [("add", order) for order in sorted(resting.values(), key=lambda o: o.time)]
+    )
+
+    return engine
 
-    return exchange
 
+def reconstruct_engine(session: SessionType, instrument: str) -> Engine:
+    with session:
+        checkpoint = (session.get("book_checkpoints") or {}).get(instrument)
+        users = list((session.get("market_users") or {}).get(instrument, []))
+
+    skip = checkpoint["entries"] if checkpoint else 0
+
+    # Entries already contained in the checkpoint are not loaded at all
+    entries = (
+        entry
+        for _, _, entry in um.get_entries(
+            book_model(session, instrument), OrderEvents, subset=slice(skip, None)
+        )
+    )
 
-def get_exchange(session: SessionType) -> Exchange:
-    key = _exchange_key(session)
-    if key not in _exchanges:
-        _exchanges[key] = reconstruct_exchange(session)
-    return _exchanges[key]
+    return restore_engine(checkpoint, users, entries, instrument)
+
+
+def get_engine(session: SessionType, instrument: str) -> Engine:
+    return _exchanges.get(
+        _exchange_key(session, instrument),
+        lambda: reconstruct_engine(session, instrument),
+    )
+
+
+def get_exchange(session: SessionType, instrument: str) -> Exchange:
+    return get_engine(session, instrument).exchange
+
+
+def get_instrument_engine(session: SessionType, instrument: str | None) -> Engine:
+    """Engine of an instrument of the session, the first one if None"""
+    names = instruments(session)
+
+    if instrument is None:
+        instrument = names[0]
+    elif instrument not in names:
+        raise ValueError("Unknown instrument")
+
+    return get_engine(session, instrument)
+
+
+def maybe_checkpoint(session: SessionType, engine: Engine) -> None:
+    if engine.book_events - engine.checkpointed >= C.CHECKPOINT_EVENTS:
+        with session:
+            checkpoints = dict(session.get("book_checkpoints") or {})
+            checkpoints[engine.instrument] = engine.checkpoint()
+            session.book_checkpoints = checkpoints
+
+        engine.checkpointed = engine.book_events
 
 
 def new_session(session: SessionType) -> None:
-    session.book_model = um.create_model(session, tag="book_events")
-    session.trade_model = um.create_model(session, tag="trade_events")
+    names = session_setting(session, "instruments")
+
+    if (
+        not isinstance(names, list)
+        or not names
+        or not all(isinstance(name, str) and name for name in names)
+        or len(set(names)) != len(names)
+    ):
+        raise ValueError("instruments must be a non-empty list of unique names")
+
+    # Model tags are numbered since instrument names are free text. Both fields
+    # are tuples of strings, which can be read without a session context.
+    session.instruments = tuple(names)
+    session.book_models = tuple(
+        um.create_model(session, tag=f"order_events_{i}").mname
+        for i in range(len(names))
+    )
+    session.market_users = {name: [] for name in names}
+    session.book_checkpoints = {}
+    session.watching = {}
+
+    for key in (
+        "order_rate",
+        "order_burst",
+        "session_order_rate",
+        "session_order_burst",
+    ):
+        value = session_setting(session, key)
+
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+            raise ValueError(f"{key} must be a positive number")
+
+    interval = session_setting(session, "update_interval")
+
+    if not isinstance(interval, int) or isinstance(interval, bool) or interval < 0:
+        raise ValueError("update_interval must be a non-negative integer")
+
+
+def get_bucket(session: SessionType, player_name: str | None) -> TokenBucket:
+    """Rate limit of a trader, or of the whole session if player_name is None"""
+    key = (session.name, player_name)
+
+    if key not in _buckets:
+        # Buckets unused for this long are full, i.e., the same as new ones
+        now = monotonic()
+
+        for stale in [k for k, b in _buckets.items() if now - b.updated > C.ENGINE_TTL]:
+            del _buckets[stale]
+
+        prefix = "" if player_name is not None else "session_"
+        _buckets[key] = TokenBucket(
+            session_setting(session, prefix + "order_rate"),
+            session_setting(session, prefix + "order_burst"),
+        )
+
+    return _buckets[key]
+
+
+def rate_limit(session: SessionType, player: PlayerType) -> None:
+    """Take a token from the trader and the session, or reject the request"""
+    now = monotonic()
+    own, shared = get_bucket(session, player.name), get_bucket(session, None)
+
+    if not own.refill(now):
+        own.rejected += 1
+
+        raise ValueError("Too many orders, please wait a moment")
+
+    if not shared.refill(now):
+        shared.rejected += 1
+
+        raise ValueError("The market is busy, please try again in a moment")
+
+    own.tokens -= 1
+    shared.tokens -= 1
+
+
+def get_throttle(session: SessionType, engine: Engine) -> UpdateThrottle:
+    if engine.throttle is None:
+        engine.throttle = UpdateThrottle(session, engine)
+
+    return engine.throttle
 
 
 def store_book_changes(
     session: SessionType,
     player: PlayerType,
-    before_orders: dict[str, Any],
-    after_orders: dict[str, Any],
+    engine: Engine,
+    changes: list[BookChange],
     trades: list[Any],
 ) -> None:
-    for oid in set(before_orders) - set(after_orders):
-        o = before_orders[oid]
-        um.add_entry(
-            session.book_model,
-            cast(PlayerIdentifier, player),
-            BookEvent,
-            action="remove",
-            order_id=o.id,
-            price=str(o.price),
-            quantity="0",
-            buy=o.buy,
-            user=o.user,
-            time=o.time,
-        )
+    """Append everything one order changed as a single entry of its ledger"""
+    if not (changes or trades):
+        return
 
-    for oid in set(before_orders) & set(after_orders):
-        if after_orders[oid].quantity != before_orders[oid].quantity:
-            o = after_orders[oid]
-            um.add_entry(
-                session.book_model,
-                cast(PlayerIdentifier, player),
-                BookEvent,
-                action="update",
-                order_id=o.id,
-                price=str(o.price),
-                quantity=str(o.quantity),
-                buy=o.buy,
-                user=o.user,
-                time=o.time,
-            )
+    users = len(engine.users)
+    fields = engine.encode(changes, trades)
 
-    for oid in set(after_orders) - set(before_orders):
-        o = after_orders[oid]
-        um.add_entry(
-            session.book_model,
-            cast(PlayerIdentifier, player),
-            BookEvent,
-            action="add",
-            order_id=o.id,
-            price=str(o.price),
-            quantity=str(o.quantity),
-            buy=o.buy,
-            user=o.user,
-            time=o.time,
-        )
+    if len(engine.users) > users:
+        with session:
+            market_users = dict(session.market_users)
+            market_users[engine.instrument] = list(engine.users)
+            session.market_users = market_users
 
-    for trade in trades:
-        um.add_entry(
-            session.trade_model,
-            cast(PlayerIdentifier, player),
-            TradeEvent,
-            buyer=trade.buyer,
-            seller=trade.seller,
-            price=str(trade.price),
-            quantity=str(trade.quantity),
-            timestamp=trade.timestamp,
-        )
+    um.add_entry(
+        book_model(session, engine.instrument),
+        cast(PlayerIdentifier, player),
+        OrderEvents,
+        **fields,
+    )
+    engine.entries += 1
+    engine.book_events += len(changes)
+
+    maybe_checkpoint(session, engine)
+
+
+def get_portfolio(session: SessionType, user: str) -> dict[str, Any]:
+    """Cash across all instruments and the units held of each"""
+    cash, stock = 0, {}
+
+    for instrument in instruments(session):
+        ticks, stock[instrument] = get_engine(session, instrument).position(user)
+        cash += ticks
+
+    return {"cash": str(cash * C.TICK), "stock": stock}
+
+
+def flush_positions(session: SessionType) -> None:
+    dirty: set[str] = set()
+
+    for instrument in instruments(session):
+        engine = get_engine(session, instrument)
+        dirty |= engine.dirty
+        engine.dirty = set()
 
+    for name in dirty:
+        portfolio = get_portfolio(session, name)
 
-def update_portfolios(session: SessionType, trades: list[Any]) -> None:
-    players_by_name = {p.name: p for p in session.players}
-    for trade in trades:
-        amount = trade.price * trade.quantity
-        buyer = players_by_name.get(trade.buyer)
-        if buyer is not None:
-            buyer.cash = str(Decimal(buyer.get("cash") or "0") - amount)
-            buyer.stock = int(buyer.get("stock") or 0) + int(trade.quantity)
-        seller = players_by_name.get(trade.seller)
-        if seller is not None:
-            seller.cash = str(Decimal(seller.get("cash") or "0") + amount)
-            seller.stock = int(seller.get("stock") or 0) - int(trade.quantity)
-
-
-def get_book_snapshot(exchange: Exchange) -> dict[str, Any]:
-    asks: dict[str, dict[str, Any]] = {}
-    for order in exchange.asks:
-        p = str(order.price)
-        if p not in asks:
-            asks[p] = {"price": str(order.price), "quantity": 0, "orders": []}
-        asks[p]["quantity"] += int(order.quantity)
-        asks[p]["orders"].append({"id": order.id, "quantity": int(order.quantity)})
-
-    bids: dict[str, dict[str, Any]] = {}
-    for order in exchange.bids:
-        p = str(order.price)
-        if p not in bids:
-            bids[p] = {"price": str(order.price), "quantity": 0, "orders": []}
-        bids[p]["quantity"] += int(order.quantity)
-        bids[p]["orders"].append({"id": order.id, "quantity": int(order.quantity)})
+        with Player(session.name, name) as trader:
+            trader.cash = portfolio["cash"]
+            trader.stock = portfolio["stock"]
 
+
+async def flush_positions_later(session: SessionType) -> None:
+    try:
+        await asyncio.sleep(C.FLUSH_INTERVAL)
+    finally:
+        _flushes.discard(session.name)
+
+    with session:
+        flush_positions(session)
+
+
+def update_portfolios(session: SessionType, engine: Engine, trades: list[Any]) -> None:
+    """Book the trades in memory and write the new positions to players soon"""
+    engine.settle(trades)
+
+    if engine.dirty and session.name not in _flushes:
+        _flushes.add(session.name)
+        spawn(flush_positions_later(session))
+
+
+def get_book_snapshot(
+    engine: Engine, depth: int | None = None, with_orders: bool = True
+) -> dict[str, Any]:
+    """Top depth levels per side (all if None), with their orders unless L2"""
     return {
-        "asks": sorted(asks.values(), key=lambda x: Decimal(x["price"])),
-        "bids": sorted(bids.values(), key=lambda x: Decimal(x["price"]), reverse=True),
+        "asks": engine.asks.snapshot(depth, with_orders),
+        "bids": engine.bids.snapshot(depth, with_orders),
     }
 
 
-def get_player_orders(exchange: Exchange, player_name: str) -> list[dict[str, Any]]:
-    orders = []
-    for order in exchange.orders.values():
-        if order.user == player_name:
-            orders.append(
-                {
-                    "id": order.id,
-                    "price": str(order.price),
-                    "quantity": int(order.quantity),
-                    "side": "buy" if order.buy else "sell",
-                }
-            )
-    return orders
+def get_player_orders(engine: Engine, player_name: str) -> list[dict[str, Any]]:
+    return [
+        {
+            "id": order.id,
+            "price": str(order.price),
+            "quantity": int(order.quantity),
+            "side": "buy" if order.buy else "sell",
+        }
+        for order in engine.user_orders.get(player_name, {}).values()
+    ]
 
 
-def get_recent_trades(exchange: Exchange, limit: int = 50) -> list[dict[str, Any]]:
+def get_recent_trades(
+    exchange: Exchange, limit: int = C.RECENT_TRADES
+) -> list[dict[str, Any]]:
     trades = []
     for trade in exchange.trades[-limit:]:
         trades.append(
@@ -236,18 +921,109 @@ def get_recent_trades(exchange: Exchange, limit: int = 50) -> list[dict[str, Any
     return trades
 
 
-def broadcast_update(
-    player: PlayerType, session: SessionType, exchange: Exchange
+def order_change(action: str, order: Order) -> dict[str, Any]:
+    return {
+        "action": action,
+        "id": order.id,
+        "price": str(order.price),
+        "quantity": 0 if action == "remove" else int(order.quantity),
+        "side": "buy" if order.buy else "sell",
+    }
+
+
+def market_update(
+    engine: Engine, prev: int, changes: list[BookChange], trades: list[METrade]
+) -> dict[str, Any]:
+    """MarketUpdate with the changes and trades since seq prev"""
+    return {
+        "instrument": engine.instrument,
+        "seq": engine.book_events,
+        "prev": prev,
+        "changes": [order_change(action, o) for action, o in changes],
+        "trades": [
+            {"price": str(t.price), "quantity": int(t.quantity)} for t in trades
+        ],
+    }
+
+
+def own_changes(
+    changes: list[BookChange], trades: list[METrade]
+) -> dict[str, list[dict[str, Any]]]:
+    """Order changes of each trader whose orders or portfolio changed"""
+    result: dict[str, list[dict[str, Any]]] = {
+        name: [] for t in trades for name in (t.buyer, t.seller)
+    }
+
+    for action, o in changes:
+        result.setdefault(o.user, []).append(order_change(action, o))
+
+    return result
+
+
+def notify_portfolio(
+    sender: PlayerType,
+    trader: PlayerType,
+    engine: Engine,
+    orders: list[dict[str, Any]],
 ) -> None:
-    book = get_book_snapshot(exchange)
-    trades = get_recent_trades(exchange)
     notify(
-        player,
-        session.players,
-        {"book": book, "trades": trades},
-        event="MarketUpdate",
+        sender,
+        trader,
+        {
+            "instrument": engine.instrument,
+            "orders": orders,
+            **get_portfolio(sender.session, trader.name),
+        },
+        event="PortfolioUpdate",
+    )
+
+
+def subscribe(session: SessionType, player_name: str, instrument: str) -> None:
+    """Send a player the MarketUpdates of this instrument only"""
+    with session:
+        watching = dict(session.get("watching") or {})
+
+        if watching.get(player_name) != instrument:
+            session.watching = {**watching, player_name: instrument}
+
+
+def broadcast_update(
+    player: PlayerType,
+    session: SessionType,
+    engine: Engine,
+    changes: list[BookChange],
+    trades: list[Any],
+) -> None:
+    """
+    Send the players watching the instrument its book changes and new trades,
+    and each affected trader their own order changes and portfolio
+
+    Clients apply MarketUpdates to their copy of the book as long as prev
+    matches the seq they have. Otherwise they missed one and call get_state.
+    MarketUpdates are sent at most once per update interval (in milliseconds).
+    """
+    throttle = get_throttle(session, engine)
+    throttle.queue(player, changes, trades)
+
+    delay = (
+        throttle.sent_at
+        + session_setting(session, "update_interval") / 1000
+        - monotonic()
     )
 
+    if delay <= 0:
+        throttle.flush()
+    elif not throttle.scheduled:
+        throttle.scheduled = True
+        spawn(throttle.flush_later(delay))
+
+    for name, orders in own_changes(changes, trades).items():
+        if name == player.name:
+            notify_portfolio(player, player, engine, orders)
+        else:
+            with Player(session.name, name) as trader:
+                notify_portfolio(player, trader, engine, orders)
+
 
 class Trading(Page):
     @classmethod
@@ -255,20 +1031,37 @@ class Trading(Page):
         if player.get("cash") is None:
             player.cash = "0"
         if player.get("stock") is None:
-            player.stock = 0
+            player.stock = {name: 0 for name in instruments(player.session)}
+
+    @classmethod
+    async def jsvars(page, player: PlayerType) -> dict[str, Any]:
+        return dict(instruments=instruments(player.session))
 
     @live
-    def get_state(page, player: PlayerType) -> Any:
-        exchange = get_exchange(player.session)
-        book = get_book_snapshot(exchange)
+    def get_state(page, player: PlayerType, instrument: str | None = None) -> Any:
+        """Full state of an instrument, whose updates the player receives from now"""
+        session = player.session
+        engine = get_instrument_engine(session, instrument)
+        exchange = engine.exchange
+        book = get_book_snapshot(engine)
         trades = get_recent_trades(exchange)
-        my_orders = get_player_orders(exchange, player.name)
+        my_orders = get_player_orders(engine, player.name)
+        throttle = get_throttle(session, engine)
+        subscribe(session, player.name, engine.instrument)
+
         return {
+            "instrument": engine.instrument,
+            "seq": engine.book_events,
             "book": book,
             "trades": trades,
             "my_orders": my_orders,
-            "cash": player.get("cash") or "0",
-            "stock": int(player.get("stock") or 0),
+            # The next MarketUpdate starts before this state, see market.js
+            "pending": (
+                {"prev": throttle.seq, "trades": len(throttle.trades)}
+                if throttle.queued
+                else None
+            ),
+            **get_portfolio(session, player.name),
         }
 
     @live
@@ -279,78 +1072,103 @@ class Trading(Page):
         side: str,
         price: str | None,
         quantity: int,
+        instrument: str | None = None,
     ) -> Any:
-        if order_type not in ("limit", "market"):
-            raise ValueError("order_type must be 'limit' or 'market'")
+        if order_type not in C.ORDER_TYPES:
+            raise ValueError("order_type must be 'limit', 'market', 'ioc' or 'fok'")
         if side not in ("buy", "sell"):
             raise ValueError("side must be 'buy' or 'sell'")
         if quantity <= 0:
             raise ValueError("quantity must be positive")
 
         session = player.session
-        exchange = get_exchange(session)
+        engine = get_instrument_engine(session, instrument)
+        rate_limit(session, player)
         is_buy = side == "buy"
+        dec_price = None
 
-        if order_type == "limit":
+        if order_type != "market":
             if price is None:
-                raise ValueError("Price required for limit orders")
+                raise ValueError("Price required for all but market orders")
             dec_price = Decimal(price)
             if dec_price <= 0:
                 raise ValueError("Price must be positive")
-        else:
-            if is_buy:
-                if not exchange.asks:
-                    raise ValueError("No sell orders available")
-                dec_price = max(order.price for order in exchange.asks)
-            else:
-                if not exchange.bids:
-                    raise ValueError("No buy orders available")
-                dec_price = min(order.price for order in exchange.bids)
-
-        before_orders = dict(exchange.orders)
+            if dec_price % C.TICK != 0:
+                raise ValueError(f"Price must be a multiple of {C.TICK}")
 
         try:
-            order, trades = exchange.place(
-                dec_price, Decimal(quantity), player.name, is_buy
-            )
+            if order_type == "limit":
+                _, trades, changes = engine.place(
+                    cast(Decimal, dec_price), Decimal(quantity), player.name, is_buy
+                )
+            else:
+                _, trades, changes = engine.sweep(
+                    dec_price,
+                    Decimal(quantity),
+                    player.name,
+                    is_buy,
+                    all_or_none=order_type == "fok",
+                )
         except ValueError as e:
             raise ValueError(str(e))
 
-        # For market orders, cancel any resting remainder
-        if order_type == "market" and order.quantity > 0:
-            exchange.cancel(order.id)
+        update_portfolios(session, engine, trades)
+        store_book_changes(session, player, engine, changes, trades)
+        broadcast_update(player, session, engine, changes, trades)
 
-        after_orders = dict(exchange.orders)
-        store_book_changes(session, player, before_orders, after_orders, trades)
-        update_portfolios(session, trades)
-        broadcast_update(player, session, exchange)
-
-        return {
-            "cash": player.get("cash") or "0",
-            "stock": int(player.get("stock") or 0),
-        }
+        return get_portfolio(session, player.name)
 
     @live
-    def cancel_order(page, player: PlayerType, order_id: str) -> Any:
+    def cancel_order(
+        page, player: PlayerType, order_id: str, instrument: str | None = None
+    ) -> Any:
         session = player.session
-        exchange = get_exchange(session)
+        engine = get_instrument_engine(session, instrument)
+        exchange = engine.exchange
 
         if order_id not in exchange.orders:
             raise ValueError("Order not found")
         if exchange.orders[order_id].user != player.name:
             raise ValueError("Cannot cancel another player's order")
 
-        before_orders = dict(exchange.orders)
-        exchange.cancel(order_id)
-        after_orders = dict(exchange.orders)
+        rate_limit(session, player)
 
-        store_book_changes(session, player, before_orders, after_orders, [])
-        broadcast_update(player, session, exchange)
+        changes = engine.cancel(order_id)
 
-        return {
-            "cash": player.get("cash") or "0",
-            "stock": int(player.get("stock") or 0),
-        }
+        store_book_changes(session, player, engine, changes, [])
+        broadcast_update(player, session, engine, changes, [])
+
+        return get_portfolio(session, player.name)
+
+
+def digest(session: SessionType) -> dict[str, Any]:
+    books = []
+
+    for instrument in instruments(session):
+        engine = get_engine(session, instrument)
+        throttle = get_throttle(session, engine)
+        books.append(
+            {
+                "instrument": instrument,
+                "orders": len(engine.exchange.orders),
+                "traders": len(engine.users),
+                "entries": engine.entries,
+                "book_events": engine.book_events,
+                "updates": throttle.sent,
+                "merged": throttle.merged,
+            }
+        )
+
+    rejected = {
+        "traders": sum(
+            bucket.rejected
+            for (name, trader), bucket in _buckets.items()
+            if name == session.name and trader is not None
+        ),
+        "session": get_bucket(session, None).rejected,
+    }
+
+    return {"books": books, "rejected": rejected, "registry": _exchanges.stats()}
 
 
 page_order = [Trading]
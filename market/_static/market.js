@@ -18,11 +18,17 @@ function quantityFormatter(val) {
 
 function marketApp() {
     return {
+        instruments: uproot.vars.instruments,
+        instrument: uproot.vars.instruments[0],
         book: { asks: [], bids: [] },
         trades: [],
         myOrders: [],
+        seq: 0,
+        pending: null,  // {prev, trades} of a MarketUpdate that began before our state
+        syncing: false,
+        heldUpdates: [],
         cash: "0",
-        stock: 0,
+        stock: {},
         orderType: "limit",
         orderSide: "buy",
         orderPrice: "",
@@ -32,28 +38,143 @@ function marketApp() {
         error: "",
 
         init() {
-            uproot.onReady(() => {
-                uproot.invoke("get_state").then(state => {
-                    this.book = state.book;
-                    this.trades = state.trades;
-                    this.myOrders = state.my_orders;
-                    this.cash = state.cash;
-                    this.stock = state.stock;
-                });
-            });
+            uproot.onReady(() => this.resync());
 
             uproot.onCustomEvent("MarketUpdate", event => {
+                this.receiveUpdate(event.detail.data);
+            });
+
+            uproot.onCustomEvent("PortfolioUpdate", event => {
                 const data = event.detail.data;
-                this.book = data.book;
-                this.trades = data.trades;
-                uproot.invoke("get_state").then(state => {
-                    this.myOrders = state.my_orders;
-                    this.cash = state.cash;
-                    this.stock = state.stock;
-                });
+
+                if (data.instrument === this.instrument) {
+                    data.orders.forEach(change => this.applyOwnChange(change));
+                }
+
+                this.cash = data.cash;
+                this.stock = data.stock;
             });
         },
 
+        selectInstrument(instrument) {
+            // The server sends updates of the selected instrument only
+            this.instrument = instrument;
+            this.heldUpdates = [];
+            this.error = "";
+            this.resync();
+        },
+
+        resync() {
+            // Only needed on load, when switching instruments and when an update was missed
+            const instrument = this.instrument;
+            this.syncing = true;
+
+            uproot.invoke("get_state", instrument).then(state => {
+                if (instrument !== this.instrument) return;
+
+                this.book = state.book;
+                this.trades = state.trades;
+                this.myOrders = state.my_orders;
+                this.cash = state.cash;
+                this.stock = state.stock;
+                this.seq = state.seq;
+                this.pending = state.pending;
+                this.syncing = false;
+
+                if (this.error.startsWith("Could not load the market")) this.error = "";
+
+                const held = this.heldUpdates;
+                this.heldUpdates = [];
+                held.forEach(update => this.receiveUpdate(update));
+            }).catch(err => {
+                if (instrument !== this.instrument) return;
+
+                // Keep holding updates until a state arrives to apply them to
+                this.error = `Could not load the market, retrying: ${err.message || err}`;
+                setTimeout(() => {
+                    if (instrument === this.instrument && this.syncing) this.resync();
+                }, 2000);
+            });
+        },
+
+        receiveUpdate(update) {
+            if (update.instrument !== this.instrument) {
+                // Sent before the server knew that we switched
+            }
+            else if (this.syncing) {
+                this.heldUpdates.push(update);
+            }
+            else if (this.pending && update.prev === this.pending.prev) {
+                // Merged before and after our state: replaying the changes leaves
+                // the orders we have as they are, but the trades must be skipped
+                update.changes.forEach(change => this.applyChange(change));
+                this.trades = this.trades.concat(update.trades.slice(this.pending.trades)).slice(-50);
+                this.seq = update.seq;
+                this.pending = null;
+            }
+            else if (update.prev < this.seq) {
+                // Already contained in the state we have
+            }
+            else if (update.prev > this.seq) {
+                this.heldUpdates.push(update);
+                this.resync();
+            }
+            else {
+                update.changes.forEach(change => this.applyChange(change));
+                this.trades = this.trades.concat(update.trades).slice(-50);
+                this.seq = update.seq;
+            }
+        },
+
+        applyChange(change) {
+            const buy = change.side === "buy";
+            const levels = buy ? this.book.bids : this.book.asks;
+            const price = parseFloat(change.price);
+            let i = levels.findIndex(level => parseFloat(level.price) === price);
+
+            if (i === -1) {
+                if (change.action !== "add") return;
+
+                i = levels.findIndex(level => buy ? parseFloat(level.price) < price : parseFloat(level.price) > price);
+                i = i === -1 ? levels.length : i;
+                levels.splice(i, 0, {price: change.price, quantity: 0, orders: []});
+            }
+
+            const level = levels[i];
+            const j = level.orders.findIndex(order => order.id === change.id);
+
+            if (change.action === "add" && j === -1) {
+                level.orders.push({id: change.id, quantity: change.quantity});
+                level.quantity += change.quantity;
+            }
+            else if (change.action === "update" && j !== -1) {
+                level.quantity += change.quantity - level.orders[j].quantity;
+                level.orders[j].quantity = change.quantity;
+            }
+            else if (change.action === "remove" && j !== -1) {
+                level.quantity -= level.orders[j].quantity;
+                level.orders.splice(j, 1);
+            }
+
+            if (level.orders.length === 0) {
+                levels.splice(i, 1);
+            }
+        },
+
+        applyOwnChange(change) {
+            const j = this.myOrders.findIndex(order => order.id === change.id);
+
+            if (change.action === "remove") {
+                if (j !== -1) this.myOrders.splice(j, 1);
+            }
+            else if (j !== -1) {
+                this.myOrders[j].quantity = change.quantity;
+            }
+            else if (change.action === "add") {
+                this.myOrders.push({id: change.id, price: change.price, quantity: change.quantity, side: change.side});
+            }
+        },
+
         spreadText() {
             if (this.book.asks.length > 0 && this.book.bids.length > 0) {
                 const bestAsk = parseFloat(this.book.asks[0].price);
@@ -71,7 +192,7 @@ function marketApp() {
                 return;
             }
             let price = null;
-            if (this.orderType === "limit") {
+            if (this.orderType !== "market") {
                 price = this.orderPrice;
                 if (!price || parseFloat(price) <= 0) {
                     this.error = "Enter a valid price";
@@ -81,7 +202,7 @@ function marketApp() {
             }
 
             this.submitting = true;
-            uproot.invoke("submit_order", this.orderType, this.orderSide, price, qty)
+            uproot.invoke("submit_order", this.orderType, this.orderSide, price, qty, this.instrument)
                 .then(result => {
                     this.cash = result.cash;
                     this.stock = result.stock;
@@ -98,7 +219,7 @@ function marketApp() {
 
         cancelOrder(orderId) {
             this.cancelling = orderId;
-            uproot.invoke("cancel_order", orderId)
+            uproot.invoke("cancel_order", orderId, this.instrument)
                 .then(result => {
                     this.cash = result.cash;
                     this.stock = result.stock;
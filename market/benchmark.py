@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# Docs are available at https://uproot.science/
+# Examples are available at https://github.com/mrpg/uproot-examples
+#
+# This example app is under the 0BSD license. You can use it freely and build on it
+# without any limitations and without any attribution. However, these two lines must be
+# preserved in any uproot app (the license file is automatically installed in projects):
+#
+# Third-party dependencies:
+# - uproot: LGPL v3+, see ../uproot_license.txt
+
+"""
+Market benchmarks
+
+Runs parts of the market app in-process against synthetic order flows. From the
+project directory (with the project's dependencies installed):
+
+    python -m market.benchmark recovery --events 1000 10000 100000 --depth 1000
+    python -m market.benchmark ledger --depth 1000 --sweep 30
+    python -m market.benchmark engine --depth 10 1000 100000 --players 10 100
+
+`recovery` measures how long rebuilding the in-memory exchange after a restart
+takes, once by replaying the whole ledger and once from the latest checkpoint
+plus the entries written after it. The book is kept at a depth of resting orders
+(1,000 by default) while the ledger is written. Reading the ledger from storage
+is not included, only decoding the entries and rebuilding the book; the app
+only loads the entries after the checkpoint.
+
+`ledger` compares writing one entry per book change and trade (with prices,
+quantities and users as strings, as the app used to) with writing one compact
+entry per order. It counts the appends and encoded bytes per order and times
+the encoding; the latency of the storage itself is not included.
+
+`engine` measures the cost of each stage of an order: matching (place),
+store_book_changes (store), update_portfolios followed by the write of the
+positions (portfolios), an L2 snapshot of the top of the book (snapshot), and
+broadcast_update with the MarketUpdate for the subscribers and the
+PortfolioUpdates (broadcast). It runs a mix of cancellations, limit orders that
+rest and marketable orders against books of different depths and sessions of
+different sizes, and reports the time and the memory allocated (peak, from
+tracemalloc) per order and stage. The book is refilled to its depth between
+orders. The app's own functions are called, with storage, notifications and
+background tasks replaced by no-ops. Notifications are still encoded as JSON,
+every MarketUpdate is sent without merging, and positions are written after
+every order instead of once per flush interval.
+"""
+
+import argparse
+import json
+import random
+import tracemalloc
+from collections.abc import Callable, Iterator
+from contextlib import nullcontext
+from decimal import Decimal
+from statistics import mean, quantiles
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Self
+
+import market
+from market import C, Engine, get_book_snapshot, restore_engine
+
+Flow = list[tuple[list[Any], list[Any]]]  # Changes and trades of each order
+LEVEL_DEPTH = 10  # Resting orders per price level in the synthetic books
+
+
+def rest(
+    engine: Engine, rand: random.Random, players: int
+) -> tuple[list[Any], list[Any]]:
+    """Add a limit order that does not cross the spread"""
+    buy = rand.random() < 0.5
+    levels = max(1, len(engine.exchange.orders) // (2 * LEVEL_DEPTH))
+    offset = rand.randrange(levels + 1)
+    ticks = 999 - offset if buy else 1001 + offset
+
+    _, trades, changes = engine.place(
+        Decimal(ticks) * C.TICK,
+        Decimal(rand.randint(1, 10)),
+        f"p{rand.randrange(players)}",
+        buy,
+    )
+
+    return changes, trades
+
+
+def order_flow(
+    engine: Engine, n: int, depth: int = 0, seed: int = 0
+) -> Iterator[tuple[list[Any], list[Any]]]:
+    """
+    Changes and trades of up to n random limit orders and cancellations, with
+    the book refilled to depth resting orders in between
+    """
+    rand = random.Random(seed)
+
+    for _ in range(n):
+        if len(engine.exchange.orders) < depth:
+            yield rest(engine, rand, 100)
+            continue
+
+        if engine.exchange.orders and rand.random() < 0.3:
+            oid = rand.choice(list(engine.exchange.orders))
+            yield engine.cancel(oid), []
+            continue
+
+        buy = rand.random() < 0.5
+        price = Decimal(rand.randint(950, 1050)) * C.TICK
+        user = f"p{rand.randrange(100)}"
+
+        try:
+            _, trades, changes = engine.place(
+                price, Decimal(rand.randint(1, 10)), user, buy
+            )
+        except ValueError:
+            # Self-trades are rejected
+            continue
+
+        yield changes, trades
+
+
+def timed(repeat: int, f: Callable[..., Any], *args: Any) -> float:
+    """Best of repeat runs of f(*args) in milliseconds"""
+    best = float("inf")
+
+    for _ in range(repeat):
+        started = perf_counter()
+        f(*args)
+        best = min(best, perf_counter() - started)
+
+    return best * 1000
+
+
+def recovery(args: argparse.Namespace) -> None:
+    print(
+        f"{'events':>10}  {'resting':>8}  {'full replay ms':>15}  "
+        f"{'checkpoint + tail ms':>21}  {'tail':>6}"
+    )
+
+    for n in args.events:
+        live = Engine()
+        entries: list[SimpleNamespace] = []
+        checkpoint = None
+
+        # Write the ledger and checkpoints like the app does
+        for changes, trades in order_flow(live, 10 * n, args.depth):
+            entries.append(SimpleNamespace(**live.encode(changes, trades)))
+            live.entries += 1
+            live.book_events += len(changes)
+
+            if live.book_events - live.checkpointed >= args.interval:
+                checkpoint = live.checkpoint()
+                live.checkpointed = live.book_events
+
+            if live.book_events >= n:
+                break
+
+        tail = entries[checkpoint["entries"] :] if checkpoint else entries
+        full_ms = timed(args.repeat, restore_engine, None, live.users, entries)
+        tail_ms = timed(args.repeat, restore_engine, checkpoint, live.users, tail)
+        events = sum(len(entry.book) for entry in tail)
+
+        print(
+            f"{live.book_events:>10}  {len(live.exchange.orders):>8}  "
+            f"{full_ms:>15.2f}  {tail_ms:>21.2f}  {events:>6}"
+        )
+
+
+def per_event_rows(changes: list[Any], trades: list[Any]) -> list[dict[str, Any]]:
+    """One entry per book change and trade, as the app used to write them"""
+    rows = [
+        {
+            "action": action,
+            "order_id": o.id,
+            "price": str(o.price),
+            "quantity": "0" if action == "remove" else str(o.quantity),
+            "buy": o.buy,
+            "user": o.user,
+            "time": o.time,
+        }
+        for action, o in changes
+    ]
+
+    return rows + [
+        {
+            "buyer": t.buyer,
+            "seller": t.seller,
+            "price": str(t.price),
+            "quantity": str(t.quantity),
+            "timestamp": t.timestamp,
+        }
+        for t in trades
+    ]
+
+
+def encode_flow(
+    encode: Callable[[list[Any], list[Any]], list[Any]], flow: Flow
+) -> list[list[Any]]:
+    return [encode(changes, trades) for changes, trades in flow]
+
+
+def ledger(args: argparse.Namespace) -> None:
+    rand = random.Random(0)
+    engine = Engine()
+    flow: Flow = []
+
+    # A deep book of small resting orders that aggressive orders sweep through
+    for i in range(args.depth):
+        buy = i % 2 == 0
+        ticks = 999 - i // 20 if buy else 1001 + i // 20
+        engine.place(Decimal(ticks) * C.TICK, Decimal(1), f"p{i % 100}", buy)
+
+    for _ in range(args.orders):
+        _, trades, changes = engine.sweep(
+            None, Decimal(args.sweep), "taker", rand.random() < 0.5, all_or_none=False
+        )
+        flow.append((changes, trades))
+
+        # Refill what was taken so that every sweep is equally deep
+        for _, o in changes:
+            engine.place(o.price, Decimal(1), o.user, o.buy)
+
+    paths: dict[str, Callable[[list[Any], list[Any]], list[Any]]] = {
+        "per event": per_event_rows,
+        "per order": lambda changes, trades: [engine.encode(changes, trades)],
+    }
+
+    print(
+        f"{'path':<10}  {'appends/order':>13}  {'bytes/order':>11}  "
+        f"{'encode us/order':>15}"
+    )
+
+    for name, encode in paths.items():
+        rows = encode_flow(encode, flow)
+        appends = sum(len(r) for r in rows) / len(flow)
+        size = sum(len(json.dumps(row)) for r in rows for row in r) / len(flow)
+        encode_ms = timed(args.repeat, encode_flow, encode, flow)
+
+        print(
+            f"{name:<10}  {appends:>13.1f}  {size:>11.0f}  "
+            f"{encode_ms * 1000 / len(flow):>15.1f}"
+        )
+
+
+STAGES = ("place", "store", "portfolios", "snapshot", "broadcast")
+ORDER_KINDS = ("cancel", "limit", "marketable")
+
+
+def go_offline() -> None:
+    """Replace the app's storage, notifications and background tasks by no-ops"""
+    market.um = SimpleNamespace(add_entry=lambda *args, **kwargs: None)
+    market.notify = lambda sender, recipients, data, **kwargs: json.dumps(data)
+    market.spawn = lambda coro: coro.close()
+    market.Player = lambda sname, uname: nullcontext(SimpleNamespace(name=uname))
+
+
+class OfflineSession(SimpleNamespace):
+    """Stands in for the session's storage, including its context manager"""
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+
+def offline_session(engine: Engine, players: int) -> OfflineSession:
+    """A session trading only the engine's instrument, watched by all players"""
+    session = OfflineSession(
+        name="benchmark",
+        settings={"update_interval": 0},
+        instruments=(engine.instrument,),
+        book_models=(engine.instrument,),
+        market_users={engine.instrument: []},
+        book_checkpoints={},
+    )
+    session.players = [
+        SimpleNamespace(name=f"p{i}", session=session, show_page=0)
+        for i in range(players)
+    ]
+    session.watching = {p.name: engine.instrument for p in session.players}
+
+    market._exchanges = market.EngineRegistry()
+    market._exchanges.get(
+        market._exchange_key(session, engine.instrument), lambda: engine
+    )
+
+    return session
+
+
+def portfolios(session: OfflineSession, engine: Engine, trades: list[Any]) -> None:
+    """Book the trades, and write the positions as if the flush was due"""
+    market.update_portfolios(session, engine, trades)
+    market.flush_positions(session)
+
+
+def stage_samples(
+    depth: int, players: int, mix: list[float], orders: int, traced: bool
+) -> tuple[dict[str, list[float]], Engine]:
+    """
+    Time (in seconds) or peak allocation (in bytes, if traced) of each stage of
+    each order; the same seed gives the same orders in both modes
+    """
+    rand = random.Random(0)
+    engine = Engine("benchmark")
+    session = offline_session(engine, players)
+    samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+
+    while len(engine.exchange.orders) < depth:
+        rest(engine, rand, players)
+
+    def measure(stage: str, f: Callable[..., Any], *args: Any) -> Any:
+        if traced:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = f(*args)
+            samples[stage].append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            started = perf_counter()
+            result = f(*args)
+            samples[stage].append(perf_counter() - started)
+
+        return result
+
+    if traced:
+        tracemalloc.start()
+
+    for _ in range(orders):
+        kind = rand.choices(ORDER_KINDS, weights=mix)[0]
+        trader = rand.choice(session.players)
+        user = trader.name
+        own = engine.user_orders.get(user)
+
+        try:
+            if kind == "cancel" and own:
+                oid = next(iter(own))
+                changes, trades = measure("place", engine.cancel, oid), []
+            elif kind == "marketable":
+                _, trades, changes = measure(
+                    "place",
+                    engine.sweep,
+                    None,
+                    Decimal(rand.randint(1, 30)),
+                    user,
+                    rand.random() < 0.5,
+                    False,
+                )
+            else:
+                buy = rand.random() < 0.5
+                ticks = 999 - rand.randrange(5) if buy else 1001 + rand.randrange(5)
+                _, trades, changes = measure(
+                    "place",
+                    engine.place,
+                    Decimal(ticks) * C.TICK,
+                    Decimal(rand.randint(1, 10)),
+                    user,
+                    buy,
+                )
+        except ValueError:
+            # Only own orders on the other side
+            continue
+
+        store = market.store_book_changes
+        broadcast = market.broadcast_update
+        measure("store", store, session, trader, engine, changes, trades)
+        measure("portfolios", portfolios, session, engine, trades)
+        measure("snapshot", get_book_snapshot, engine, 10, False)
+        measure("broadcast", broadcast, trader, session, engine, changes, trades)
+
+        # Keep the depth of the book steady
+        while len(engine.exchange.orders) < depth:
+            rest(engine, rand, players)
+        while len(engine.exchange.orders) > depth:
+            engine.cancel(next(iter(engine.exchange.orders)))
+
+    if traced:
+        tracemalloc.stop()
+
+    return samples, engine
+
+
+def p99(values: list[float]) -> float:
+    return quantiles(values, n=100)[-1] if len(values) > 1 else values[0]
+
+
+def engine_stages(args: argparse.Namespace) -> None:
+    go_offline()
+    print(
+        f"{'depth':>7}  {'players':>7}  {'stage':<10}  {'mean us':>9}  "
+        f"{'p99 us':>9}  {'alloc B':>9}"
+    )
+
+    for depth in args.depth:
+        for players in args.players:
+            times, engine = stage_samples(
+                depth, players, args.mix, args.orders, traced=False
+            )
+            allocs, _ = stage_samples(depth, players, args.mix, args.orders, True)
+
+            for stage in STAGES:
+                print(
+                    f"{depth:>7}  {players:>7}  {stage:<10}  "
+                    f"{mean(times[stage]) * 1e6:>9.1f}  "
+                    f"{p99(times[stage]) * 1e6:>9.1f}  "
+                    f"{mean(allocs[stage]):>9.0f}"
+                )
+
+            total = [sum(values) for values in zip(*times.values(), strict=True)]
+            state_ms = timed(args.repeat, get_book_snapshot, engine)
+
+            print(
+                f"{depth:>7}  {players:>7}  {'total':<10}  "
+                f"{mean(total) * 1e6:>9.1f}  {p99(total) * 1e6:>9.1f}  "
+                f"{'':>9}  (full L3 snapshot for get_state: {state_ms:.2f} ms)"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(required=True)
+
+    recovery_parser = commands.add_parser(
+        "recovery", help="cold-start time against event count"
+    )
+    recovery_parser.add_argument(
+        "--events", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    recovery_parser.add_argument(
+        "--interval",
+        type=int,
+        default=C.CHECKPOINT_EVENTS,
+        help="book events between checkpoints",
+    )
+    recovery_parser.add_argument(
+        "--depth", type=int, default=1_000, help="resting orders"
+    )
+    recovery_parser.add_argument("--repeat", type=int, default=3)
+    recovery_parser.set_defaults(func=recovery)
+
+    ledger_parser = commands.add_parser(
+        "ledger", help="per-event against per-order ledger appends"
+    )
+    ledger_parser.add_argument(
+        "--depth", type=int, default=1_000, help="resting orders"
+    )
+    ledger_parser.add_argument(
+        "--sweep", type=int, default=30, help="resting orders each order takes"
+    )
+    ledger_parser.add_argument("--orders", type=int, default=1_000)
+    ledger_parser.add_argument("--repeat", type=int, default=3)
+    ledger_parser.set_defaults(func=ledger)
+
+    engine_parser = commands.add_parser(
+        "engine", help="per-stage cost of an order against book depth and mix"
+    )
+    engine_parser.add_argument(
+        "--depth",
+        type=int,
+        nargs="+",
+        default=[10, 1_000, 100_000],
+        help="resting orders",
+    )
+    engine_parser.add_argument(
+        "--players", type=int, nargs="+", default=[10, 100], help="session sizes"
+    )
+    engine_parser.add_argument(
+        "--mix",
+        type=float,
+        nargs=3,
+        default=[30, 50, 20],
+        metavar=("CANCEL", "LIMIT", "MARKETABLE"),
+        help="relative frequency of each kind of order",
+    )
+    engine_parser.add_argument("--orders", type=int, default=2_000)
+    engine_parser.add_argument("--repeat", type=int, default=3)
+    engine_parser.set_defaults(func=engine_stages)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
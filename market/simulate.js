@@ -8,12 +8,14 @@ if (uproot.currentPage === "Trading") {
         const price = (5 + Math.random() * 10).toFixed(2);
         const quantity = Math.floor(Math.random() * 5) + 1;
         const type = Math.random() < 0.7 ? "limit" : "market";
+        const instruments = uproot.vars.instruments;
+        const instrument = instruments[Math.floor(Math.random() * instruments.length)];
         let request;
 
         if (type === "limit") {
-            request = uproot.invoke("submit_order", "limit", side, price, quantity);
+            request = uproot.invoke("submit_order", "limit", side, price, quantity, instrument);
         } else {
-            request = uproot.invoke("submit_order", "market", side, null, quantity);
+            request = uproot.invoke("submit_order", "market", side, null, quantity, instrument);
         }
 
         request.catch(() => {
@@ -8,7 +8,11 @@
 # Third-party dependencies:
 # - uproot: LGPL v3+, see ../uproot_license.txt
 
+import asyncio
 import math
+from collections import deque
+from collections.abc import Callable, Iterable, Sequence
+from time import monotonic, time
 
 import uproot.models as um
 from uproot.fields import *
@@ -21,6 +25,13 @@ LANDING_PAGE = False
 class C:
     ENDOWMENT = 100
     LIQUIDITY = 100
+    RECENT_TRADES = 50  # Most recent trades sent to clients
+    PRICE_RESOLUTIONS = (60, 60 * 60)  # Seconds per bucket of the price series
+    DIGEST_POINTS = 240  # Buckets of the price series shown in the digest at most
+    MAX_QUOTE_SHARES = 100  # Largest trade get_quotes prices
+    PRICE_TICK = 0.1  # Seconds between two PriceUpdates at least
+    WRITE_BEHIND = 1.0  # Seconds between writes of the market maker's state
+    SETTLEMENT_BATCH = 50  # Players settled per session context
     DEFAULT_EVENT_QUESTION = "Will it rain tomorrow?"
 
 
@@ -34,41 +45,73 @@ class Context(PlayerContext):
 
 
 # --- Logarithmic Market Scoring Rule (Hanson, 2003) ---
+#
+# q holds the outstanding shares of each of any number of mutually exclusive
+# outcomes. The cost function is C(q) = b log(sum(exp(q_i / b))), and buying s
+# shares of outcome i costs C(q + s e_i) - C(q) = b log(1 + p_i (exp(s / b) - 1))
+# with p_i the current price of i. Trades are priced from that closed form, which
+# needs a single log-sum-exp and stays accurate for small trades in deep markets.
 
 
-def lmsr_cost(q_yes: float, q_no: float, b: float) -> float:
-    x, y = q_yes / b, q_no / b
-    m = max(x, y)
+def log_sum_exp(xs: Sequence[float]) -> float:
+    m = max(xs)
+
+    return m + math.log(math.fsum(math.exp(x - m) for x in xs))
+
+
+def market_cost(q: Sequence[float], b: float) -> float:
+    return b * log_sum_exp([x / b for x in q])
+
+
+def market_prices(q: Sequence[float], b: float) -> list[float]:
+    xs = [x / b for x in q]
+    m = max(xs)
+    es = [math.exp(x - m) for x in xs]
+    total = math.fsum(es)
+
+    return [e / total for e in es]
+
+
+def trade_cost(q: Sequence[float], b: float, outcome: int, shares: float) -> float:
+    """Cost of buying shares of an outcome (negative: revenue of selling them)"""
+    xs = [x / b for x in q]
+    price = math.exp(xs[outcome] - log_sum_exp(xs))
+
+    return b * math.log1p(price * math.expm1(shares / b))
+
 
-    return b * (m + math.log(math.exp(x - m) + math.exp(y - m)))
+def quote_table(q: Sequence[float], b: float, max_shares: int) -> list[list[float]]:
+    """Cost of buying 1 to max_shares shares of each outcome, in one pass"""
+    growth = [math.expm1(shares / b) for shares in range(1, max_shares + 1)]
+
+    return [
+        [b * math.log1p(price * g) for g in growth] for price in market_prices(q, b)
+    ]
+
+
+# Yes/no markets are the case of two outcomes
+
+
+def lmsr_cost(q_yes: float, q_no: float, b: float) -> float:
+    return market_cost((q_yes, q_no), b)
 
 
 def lmsr_prices(q_yes: float, q_no: float, b: float) -> tuple[float, float]:
-    x, y = q_yes / b, q_no / b
-    m = max(x, y)
-    ex = math.exp(x - m)
-    ey = math.exp(y - m)
-    s = ex + ey
+    p_yes, p_no = market_prices((q_yes, q_no), b)
 
-    return ex / s, ey / s
+    return p_yes, p_no
 
 
 def compute_buy_cost(
     q_yes: float, q_no: float, b: float, is_yes: bool, shares: int
 ) -> float:
-    if is_yes:
-        return lmsr_cost(q_yes + shares, q_no, b) - lmsr_cost(q_yes, q_no, b)
-
-    return lmsr_cost(q_yes, q_no + shares, b) - lmsr_cost(q_yes, q_no, b)
+    return trade_cost((q_yes, q_no), b, 0 if is_yes else 1, shares)
 
 
 def compute_sell_revenue(
     q_yes: float, q_no: float, b: float, is_yes: bool, shares: int
 ) -> float:
-    if is_yes:
-        return lmsr_cost(q_yes, q_no, b) - lmsr_cost(q_yes - shares, q_no, b)
-
-    return lmsr_cost(q_yes, q_no, b) - lmsr_cost(q_yes, q_no - shares, b)
+    return -trade_cost((q_yes, q_no), b, 0 if is_yes else 1, -shares)
 
 
 # --- Data Model ---
@@ -83,12 +126,377 @@ class TradeEntry(metaclass=um.Entry):
     price_no_after: float
 
 
+OUTCOMES = ("yes", "no")
+
+
 def new_session(session: SessionType) -> None:
     session.q_yes = 0
     session.q_no = 0
+    session.maker_payments = 0.0
+    session.maker_trades = 0
     session.trade_log = um.create_model(session, tag="trades")
 
 
+def trade_row(entry: Any) -> dict[str, Any]:
+    return {
+        "outcome": entry.outcome,
+        "action": entry.action,
+        "shares": entry.shares,
+        "total_cost": entry.total_cost,
+        "price_yes": entry.price_yes_after,
+    }
+
+
+def add_to_buckets(
+    buckets_by_resolution: dict[int, list[list[Any]]], when: float, row: dict[str, Any]
+) -> None:
+    price, shares = row["price_yes"], row["shares"]
+
+    for resolution, buckets in buckets_by_resolution.items():
+        start = int(when // resolution) * resolution
+
+        if buckets and buckets[-1][0] == start:
+            bucket = buckets[-1]
+            bucket[2] = max(bucket[2], price)
+            bucket[3] = min(bucket[3], price)
+            bucket[4] = price
+            bucket[5] += shares
+        else:
+            buckets.append([start, price, price, price, price, shares])
+
+
+class TradeHistory:
+    """
+    Summary of a session's trade log, updated as trades are made
+
+    Attributes:
+        recent: The most recent trades
+        buckets: [start, open, high, low, close, volume] of the Yes price per
+            bucket at each resolution (in seconds), oldest first, or None until
+            the whole log has been loaded for the digest
+    """
+
+    def __init__(self) -> None:
+        self.recent: deque[dict[str, Any]] = deque(maxlen=C.RECENT_TRADES)
+        self.buckets: dict[int, list[list[Any]]] | None = None
+
+    def add(self, when: float, row: dict[str, Any]) -> None:
+        self.recent.append(row)
+
+        if self.buckets is not None:
+            add_to_buckets(self.buckets, when, row)
+
+    def load_buckets(self, rows: Iterable[tuple[float, dict[str, Any]]]) -> None:
+        buckets: dict[int, list[list[Any]]] = {r: [] for r in C.PRICE_RESOLUTIONS}
+
+        for when, row in rows:
+            add_to_buckets(buckets, when, row)
+
+        self.buckets = buckets
+
+    def series(self, max_points: int) -> tuple[int, list[list[Any]]]:
+        """
+        Resolution and buckets of the finest series with at most max_points
+        buckets, merging neighboring buckets of the coarsest if necessary
+        """
+        all_buckets = cast(dict[int, list[list[Any]]], self.buckets)  # Loaded
+
+        for resolution in sorted(all_buckets):
+            if len(all_buckets[resolution]) <= max_points:
+                return resolution, all_buckets[resolution]
+
+        resolution = max(all_buckets)
+        buckets = all_buckets[resolution]
+        step = math.ceil(len(buckets) / max_points)
+        merged = []
+
+        for i in range(0, len(buckets), step):
+            group = buckets[i : i + step]
+            merged.append(
+                [
+                    group[0][0],
+                    group[0][1],
+                    max(b[2] for b in group),
+                    min(b[3] for b in group),
+                    group[-1][4],
+                    sum(b[5] for b in group),
+                ]
+            )
+
+        return resolution * step, merged
+
+
+_histories: dict[str, TradeHistory] = {}
+
+
+def trade_history(session: SessionType) -> TradeHistory:
+    """
+    Trade history of the session, kept in memory as trades are made
+
+    After a restart, only the last C.RECENT_TRADES entries of the trade log are
+    read on first use. The price buckets are loaded by price_history.
+    """
+    key = str(session.trade_log)
+
+    if key not in _histories:
+        history = _histories[key] = TradeHistory()
+
+        for _, _, entry in um.get_entries(
+            session.trade_log, TradeEntry, subset=slice(-C.RECENT_TRADES, None)
+        ):
+            history.recent.append(trade_row(entry))
+
+    return _histories[key]
+
+
+def price_history(session: SessionType) -> TradeHistory:
+    """Trade history including the price buckets, read from the whole trade log once"""
+    history = trade_history(session)
+
+    if history.buckets is None:
+        history.load_buckets(
+            (when, trade_row(entry))
+            for _, when, entry in um.get_entries(session.trade_log, TradeEntry)
+        )
+
+    return history
+
+
+def recent_trades(session: SessionType) -> deque[dict[str, Any]]:
+    return trade_history(session).recent
+
+
+class MarketMaker:
+    """
+    State of a session's market maker, changed by a single writer
+
+    Trades are queued here and applied strictly in arrival order by a single
+    task, so each is priced off the quantities the previous one left. Trades
+    that are waiting together are applied as one batch within a single session
+    context. The state is kept in memory and written to the session fields
+    q_yes, q_no, maker_payments and maker_trades at most once per
+    C.WRITE_BEHIND seconds. After a restart, it is restored from these fields
+    and the trades logged after they were written.
+
+    Attributes:
+        q: Outstanding contracts of each outcome, in the order of OUTCOMES
+        payments: Total paid to the market maker
+        trades: Number of trades applied, which is the length of the trade log
+    """
+
+    def __init__(
+        self, session: SessionType, q: list[float], payments: float, trades: int
+    ) -> None:
+        self.session = session
+        self.q = q
+        self.payments = payments
+        self.trades = trades
+        self.queue: asyncio.Queue[tuple[Callable[[], Any], asyncio.Future[Any]]] = (
+            asyncio.Queue()
+        )
+        self.running = False
+        self.write_scheduled = False
+
+    def prices(self) -> list[float]:
+        return market_prices(self.q, C.LIQUIDITY)
+
+    def apply(self, outcome: int, shares: int, total_cost: float) -> None:
+        self.q[outcome] += shares
+        self.payments += total_cost
+        self.trades += 1
+
+    async def submit(self, operation: Callable[[], Any]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((operation, future))
+
+        if not self.running:
+            self.running = True
+            spawn(self.run())
+
+        return await future
+
+    async def run(self) -> None:
+        batch: list[tuple[Callable[[], Any], asyncio.Future[Any]]] = []
+
+        try:
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            with self.session:
+                for operation, future in batch:
+                    if future.done():
+                        continue
+
+                    try:
+                        future.set_result(operation())
+                    except Exception as e:
+                        future.set_exception(e)
+
+            if not self.write_scheduled:
+                self.write_scheduled = True
+                spawn(self.write_later())
+        except BaseException as e:
+            # Nobody else resolves the futures of the failed batch
+            for _, future in batch:
+                if future.done():
+                    continue
+
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                else:
+                    future.cancel()
+
+            raise
+        finally:
+            self.running = False
+
+            if not self.queue.empty():
+                self.running = True
+                spawn(self.run())
+
+    def write(self) -> None:
+        self.session.q_yes, self.session.q_no = self.q
+        self.session.maker_payments = self.payments
+        self.session.maker_trades = self.trades
+
+    async def write_later(self) -> None:
+        await asyncio.sleep(C.WRITE_BEHIND)
+
+        self.write_scheduled = False
+
+        with self.session:
+            self.write()
+
+
+_makers: dict[str, MarketMaker] = {}
+
+
+def restore_maker(session: SessionType) -> MarketMaker:
+    trades = session.get("maker_trades")
+
+    if trades is None:
+        # Sessions from before the write-behind state: replay the whole log
+        maker = MarketMaker(session, [0, 0], 0.0, 0)
+    else:
+        maker = MarketMaker(
+            session,
+            [session.get("q_yes") or 0, session.get("q_no") or 0],
+            float(session.get("maker_payments") or 0),
+            trades,
+        )
+
+    for _, _, entry in um.get_entries(
+        session.trade_log, TradeEntry, subset=slice(maker.trades, None)
+    ):
+        sign = 1 if entry.action == "buy" else -1
+        maker.apply(
+            OUTCOMES.index(entry.outcome), sign * entry.shares, entry.total_cost
+        )
+
+    return maker
+
+
+def get_maker(session: SessionType) -> MarketMaker:
+    if session.get("trade_log") is None:
+        session.trade_log = um.create_model(session, tag="trades")
+
+    key = str(session.trade_log)
+
+    if key not in _makers:
+        _makers[key] = restore_maker(session)
+
+    return _makers[key]
+
+
+class PriceTicker:
+    """
+    PriceUpdates of a session, sent at most once per C.PRICE_TICK
+
+    A trade in a quiet market is sent right away. Trades that follow within the
+    tick are collected and sent together at its end, with the prices and
+    quantities after the last of them.
+
+    Attributes:
+        sent: Number of PriceUpdates sent (one per update, not per recipient)
+        merged: Number of trades whose update was merged into a later one
+    """
+
+    def __init__(self, session: SessionType) -> None:
+        self.session = session
+        self.where: int | None = None  # Page of the first sender, see notify
+        self.market: dict[str, Any] = {}
+        self.trades: list[dict[str, Any]] = []
+        self.sent_at = 0.0
+        self.scheduled = False
+
+        self.sent = 0
+        self.merged = 0
+
+    def queue(
+        self, sender: PlayerType, market: dict[str, Any], trade: dict[str, Any]
+    ) -> None:
+        if self.where is None:
+            self.where = sender.show_page
+
+        self.market = market
+        self.trades.append(trade)
+
+    def flush(self) -> None:
+        if not self.trades:
+            return
+
+        notify(
+            self.session,
+            self.session.players,
+            {**self.market, "trades": self.trades},
+            event="PriceUpdate",
+            where=self.where,
+        )
+
+        # Only cleared once sent, so that a failed send is retried with the next
+        self.sent += 1
+        self.merged += len(self.trades) - 1
+        self.sent_at = monotonic()
+
+        self.where = None
+        self.trades = []
+
+    async def flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        self.scheduled = False
+
+        with self.session:
+            self.flush()
+
+
+_tickers: dict[str, PriceTicker] = {}
+
+
+def broadcast_prices(
+    sender: PlayerType,
+    session: SessionType,
+    market: dict[str, Any],
+    trade: dict[str, Any],
+) -> None:
+    """Send everyone the new prices and the trade, within the current tick"""
+    key = str(session.trade_log)
+
+    if key not in _tickers:
+        _tickers[key] = PriceTicker(session)
+
+    ticker = _tickers[key]
+    ticker.queue(sender, market, trade)
+
+    delay = ticker.sent_at + C.PRICE_TICK - monotonic()
+
+    if delay <= 0:
+        ticker.flush()
+    elif not ticker.scheduled:
+        ticker.scheduled = True
+        spawn(ticker.flush_later(delay))
+
+
 # --- Pages ---
 
 
@@ -110,28 +518,17 @@ class Trading(Page):
 
     @classmethod
     def may_proceed(page, player: PlayerType) -> bool:
-        return player.session.get("event_resolved") is True
+        return player.session.get("event_resolved") is True and bool(
+            player.get("settled")
+        )
 
     @live
     def get_state(page, player: PlayerType) -> Any:
         session = player.session
-        q_yes = session.get("q_yes") or 0
-        q_no = session.get("q_no") or 0
-        p_yes, p_no = lmsr_prices(q_yes, q_no, C.LIQUIDITY)
-
-        trades = []
-
-        if session.get("trade_log") is not None:
-            for _, _, entry in um.get_entries(session.trade_log, TradeEntry):
-                trades.append(
-                    {
-                        "outcome": entry.outcome,
-                        "action": entry.action,
-                        "shares": entry.shares,
-                        "total_cost": entry.total_cost,
-                        "price_yes": entry.price_yes_after,
-                    }
-                )
+        maker = get_maker(session)
+        q_yes, q_no = maker.q
+        p_yes, p_no = maker.prices()
+        trades = list(recent_trades(session))
 
         return {
             "price_yes": p_yes,
@@ -141,13 +538,29 @@ class Trading(Page):
             "cash": float(player.get("cash") or 0),
             "yes_shares": player.get("yes_shares") or 0,
             "no_shares": player.get("no_shares") or 0,
-            "trades": trades[-50:],
+            "trades": trades,
             "resolved": session.get("event_resolved") is True,
         }
 
     @live
-    def trade(page, player: PlayerType, outcome: str, action: str, shares: int) -> Any:
-        if outcome not in ("yes", "no"):
+    def get_quotes(page, player: PlayerType, max_shares: int) -> Any:
+        """Cost of buying 1 to max_shares contracts of each outcome right now"""
+        if (
+            not isinstance(max_shares, int)
+            or isinstance(max_shares, bool)
+            or not 1 <= max_shares <= C.MAX_QUOTE_SHARES
+        ):
+            raise ValueError(f"max_shares must be between 1 and {C.MAX_QUOTE_SHARES}")
+
+        yes, no = quote_table(get_maker(player.session).q, C.LIQUIDITY, max_shares)
+
+        return {"yes": yes, "no": no}
+
+    @live
+    async def trade(
+        page, player: PlayerType, outcome: str, action: str, shares: int
+    ) -> Any:
+        if outcome not in OUTCOMES:
             raise ValueError("Invalid outcome")
 
         if action not in ("buy", "sell"):
@@ -156,123 +569,179 @@ class Trading(Page):
         if shares <= 0:
             raise ValueError("Shares must be at least 1")
 
-        if player.session.get("event_resolved"):
-            raise ValueError("Market is closed")
+        maker = get_maker(player.session)
 
-        session = player.session
-        b = C.LIQUIDITY
-        is_yes = outcome == "yes"
-        q_yes = session.get("q_yes") or 0
-        q_no = session.get("q_no") or 0
+        return await maker.submit(
+            lambda: execute_trade(player, maker, outcome, action, shares)
+        )
 
-        if action == "buy":
-            cost = compute_buy_cost(q_yes, q_no, b, is_yes, shares)
-            cash = float(player.get("cash") or 0)
 
-            if cost > cash + 0.01:
-                raise ValueError("Insufficient funds")
+def execute_trade(
+    player: PlayerType, maker: MarketMaker, outcome: str, action: str, shares: int
+) -> dict[str, Any]:
+    """Price and apply a trade, in the session's market maker task"""
+    session = player.session
 
-            player.cash = cash - cost
+    if session.get("event_resolved"):
+        raise ValueError("Market is closed")
 
-            if is_yes:
-                player.yes_shares = (player.get("yes_shares") or 0) + shares
-                session.q_yes = q_yes + shares
-            else:
-                player.no_shares = (player.get("no_shares") or 0) + shares
-                session.q_no = q_no + shares
+    index = OUTCOMES.index(outcome)
+    is_yes = outcome == "yes"
+    cash = float(player.get("cash") or 0)
+    held = (player.get("yes_shares") if is_yes else player.get("no_shares")) or 0
 
-            total_cost = cost
-        else:
-            held = (
-                player.get("yes_shares") if is_yes else player.get("no_shares")
-            ) or 0
+    if action == "buy":
+        total_cost = trade_cost(maker.q, C.LIQUIDITY, index, shares)
 
-            if shares > held:
-                raise ValueError(
-                    f"You only hold {held} {outcome.capitalize()} contracts"
-                )
+        if total_cost > cash + 0.01:
+            raise ValueError("Insufficient funds")
 
-            revenue = compute_sell_revenue(q_yes, q_no, b, is_yes, shares)
-            player.cash = float(player.get("cash") or 0) + revenue
-
-            if is_yes:
-                player.yes_shares = held - shares
-                session.q_yes = q_yes - shares
-            else:
-                player.no_shares = held - shares
-                session.q_no = q_no - shares
-
-            total_cost = -revenue
-
-        new_q_yes = session.get("q_yes") or 0
-        new_q_no = session.get("q_no") or 0
-        p_yes, p_no = lmsr_prices(new_q_yes, new_q_no, b)
-
-        if session.get("trade_log") is None:
-            session.trade_log = um.create_model(session, tag="trades")
-
-        um.add_entry(
-            session.trade_log,
-            cast(PlayerIdentifier, player),
-            TradeEntry,
-            outcome=outcome,
-            action=action,
-            shares=shares,
-            total_cost=total_cost,
-            price_yes_after=p_yes,
-            price_no_after=p_no,
-        )
+        change = shares
+    else:
+        if shares > held:
+            raise ValueError(f"You only hold {held} {outcome.capitalize()} contracts")
 
-        notify(
-            player,
-            session.players,
-            {
-                "price_yes": p_yes,
-                "price_no": p_no,
-                "q_yes": new_q_yes,
-                "q_no": new_q_no,
-                "trade": {
-                    "outcome": outcome,
-                    "action": action,
-                    "shares": shares,
-                    "total_cost": total_cost,
-                    "price_yes": p_yes,
-                },
-            },
-            event="PriceUpdate",
-        )
+        # Negative: the revenue of the sale
+        total_cost = trade_cost(maker.q, C.LIQUIDITY, index, -shares)
+        change = -shares
+
+    player.cash = cash - total_cost
+
+    if is_yes:
+        player.yes_shares = held + change
+    else:
+        player.no_shares = held + change
+
+    maker.apply(index, change, total_cost)
+    q_yes, q_no = maker.q
+    p_yes, p_no = maker.prices()
+
+    # Loaded before the new entry is added so that it is not read twice
+    history = trade_history(session)
+
+    um.add_entry(
+        session.trade_log,
+        cast(PlayerIdentifier, player),
+        TradeEntry,
+        outcome=outcome,
+        action=action,
+        shares=shares,
+        total_cost=total_cost,
+        price_yes_after=p_yes,
+        price_no_after=p_no,
+    )
+
+    trade_info = {
+        "outcome": outcome,
+        "action": action,
+        "shares": shares,
+        "total_cost": total_cost,
+        "price_yes": p_yes,
+    }
+    history.add(time(), trade_info)
 
+    market = {
+        "price_yes": p_yes,
+        "price_no": p_no,
+        "q_yes": q_yes,
+        "q_no": q_no,
+    }
+    broadcast_prices(player, session, market, trade_info)
+
+    return {
+        **market,
+        "cash": float(player.cash),
+        "yes_shares": player.yes_shares,
+        "no_shares": player.no_shares,
+    }
+
+
+def settlement_fields(
+    refunded: bool,
+    event_occurred: bool,
+    cash: float,
+    yes_shares: int,
+    no_shares: int,
+) -> dict[str, Any]:
+    """Fields of a player with this position once the market is resolved"""
+    if refunded:
         return {
-            "price_yes": p_yes,
-            "price_no": p_no,
-            "cash": float(player.cash),
-            "yes_shares": player.yes_shares,
-            "no_shares": player.no_shares,
+            "contract_payout": 0,
+            "refund_amount": C.ENDOWMENT - cash,
+            "payoff": cu(f"{C.ENDOWMENT:.2f}"),
         }
 
+    contract_payout = yes_shares if event_occurred else no_shares
 
-def settle_player(player: PlayerType) -> None:
-    player.app = __name__  # HACK
+    return {
+        "contract_payout": contract_payout,
+        "payoff": cu(f"{cash + contract_payout:.2f}"),
+    }
 
-    session = player.session
-    cash_val = player.get("cash")
-    cash = float(cash_val) if cash_val is not None else float(C.ENDOWMENT)
 
-    if session.get("refunded"):
-        net_expenditure = C.ENDOWMENT - cash
-        player.contract_payout = 0
-        player.refund_amount = net_expenditure
-        player.payoff = cu(f"{C.ENDOWMENT:.2f}")
-    else:
-        yes_payout = 1 if session.event_occurred else 0
-        no_payout = 1 - yes_payout
-        yes_shares = player.get("yes_shares") or 0
-        no_shares = player.get("no_shares") or 0
-        contract_payout = yes_shares * yes_payout + no_shares * no_payout
-        payoff = cash + contract_payout
+_settlements: set[str] = set()  # Sessions whose settlement is running
+
+
+async def settle(session: SessionType) -> None:
+    """
+    Settle all players that are not settled yet and move them to Results
+
+    The payoffs are computed in one pass over the positions of all players
+    first, and then written in batches of C.SETTLEMENT_BATCH, so that live calls
+    are served in between. Every player is marked as settled together with their
+    payoff, so an interrupted settlement continues where it stopped.
+    """
+    if session.name in _settlements:
+        return
+
+    _settlements.add(session.name)
+
+    try:
+        with session:
+            refunded = session.get("refunded") is True
+            event_occurred = session.get("event_occurred") is True
+            players = list(session.players)
+            pending = []
+
+            for player in players:
+                data = player.within(app=__name__)
+
+                if data.get("settled"):
+                    continue
+
+                cash = data.get("cash")
+                fields = settlement_fields(
+                    refunded,
+                    event_occurred,
+                    float(cash) if cash is not None else float(C.ENDOWMENT),
+                    data.get("yes_shares") or 0,
+                    data.get("no_shares") or 0,
+                )
+                pending.append((player.name, fields))
+
+            session.settlement_total = len(players)
+            session.settled = len(players) - len(pending)
 
-        player.contract_payout = contract_payout
-        player.payoff = cu(f"{payoff:.2f}")
+        for start in range(0, len(pending), C.SETTLEMENT_BATCH):
+            batch = pending[start : start + C.SETTLEMENT_BATCH]
+
+            with session:
+                for name, fields in batch:
+                    with Player(session.name, name) as player:
+                        player.app = __name__  # HACK: write this app's fields
+
+                        for key, value in fields.items():
+                            setattr(player, key, value)
+
+                        player.settled = True
+                        move_to_page(player, Results)
+
+                    # Counted once the player is written, also if a later one fails
+                    session.settled = session.settled + 1
+
+            await asyncio.sleep(0)
+    finally:
+        _settlements.discard(session.name)
 
 
 class Results(Page):
@@ -283,27 +752,13 @@ class Results(Page):
 
 
 def digest(session: SessionType) -> dict[str, Any]:
-    q_yes = session.get("q_yes") or 0
-    q_no = session.get("q_no") or 0
-    p_yes, p_no = lmsr_prices(q_yes, q_no, C.LIQUIDITY)
-
-    price_history = [0.5]
-    trades = []
-    net_payments = 0.0
-
-    if session.get("trade_log") is not None:
-        for _, _, entry in um.get_entries(session.trade_log, TradeEntry):
-            net_payments += float(entry.total_cost)
-            price_history.append(entry.price_yes_after)
-            trades.append(
-                {
-                    "outcome": entry.outcome,
-                    "action": entry.action,
-                    "shares": entry.shares,
-                    "total_cost": entry.total_cost,
-                    "price_yes": entry.price_yes_after,
-                }
-            )
+    maker = get_maker(session)
+    q_yes, q_no = maker.q
+    p_yes, p_no = maker.prices()
+
+    history = price_history(session)
+    resolution, buckets = history.series(C.DIGEST_POINTS)
+    net_payments = maker.payments
 
     positions = []
 
@@ -344,15 +799,21 @@ def digest(session: SessionType) -> dict[str, Any]:
         "price_no": p_no,
         "q_yes": q_yes,
         "q_no": q_no,
-        "price_history": price_history,
-        "num_trades": len(trades),
-        "trades": trades,
+        "price_series": [
+            dict(zip(("time", "open", "high", "low", "close", "volume"), b))
+            for b in buckets
+        ],
+        "price_resolution": resolution,
+        "num_trades": maker.trades,
+        "trades": list(history.recent),
         "positions": positions,
         "resolved": session.get("event_resolved") is True,
         "refunded": session.get("refunded") or False,
         "event_occurred": session.get("event_occurred"),
         "maker_loss": maker_loss,
         "max_maker_loss": max_maker_loss,
+        "settled": session.get("settled"),
+        "settlement_total": session.get("settlement_total"),
     }
 
 
@@ -364,20 +825,27 @@ def resolve_event(
     event_value: bool | None = None,
     refund: bool = False,
 ) -> bool:
-    if session.get("event_resolved"):
-        return True
+    """
+    Resolve the market and settle all players in the background
+
+    Once the market is resolved, calling this again resumes an interrupted
+    settlement and otherwise does nothing.
+    """
+    if not session.get("event_resolved"):
+        if refund:
+            session.refunded = True
+        else:
+            session.refunded = False
+            session.event_occurred = event_value
 
-    if refund:
-        session.refunded = True
-    else:
-        session.refunded = False
-        session.event_occurred = event_value
+        session.event_resolved = True
 
-    session.event_resolved = True
+        # execute_trade rejects the trades still queued, so the quantities are
+        # final: store them without waiting for the write-behind
+        get_maker(session).write()
 
-    for player in session.players:
-        settle_player(player)
-        move_to_page(player, Results)
+    if (session.get("settled") or 0) < len(session.players):
+        spawn(settle(session))
 
     return True
 